@@ -0,0 +1,439 @@
+"""Replay a burst of synthetic Telegram updates through knmi_bot and measure it
+
+PostgREST and the Telegram Bot API are replaced by a local stand-in, every Bot API call that answers a user takes
+`--telegram-latency` seconds. With `--mode polling` getUpdates serves the synthetic updates, with `--mode webhook` they
+are posted to the webhook server over `--connections` connections, the updates of a chat over the same connection in
+order, like a load balancer with sticky sessions. Checks that every update is answered and that the answers of a chat
+come in the order of its updates.
+
+    uv run --with-requirements knmi_bot/requirements.txt python benchmarks/bot_load.py --updates 10000 --concurrency 1 32
+    uv run --with-requirements knmi_bot/requirements.txt python benchmarks/bot_load.py --updates 10000 --concurrency 32 --mode webhook
+    uv run --with-requirements knmi_bot/requirements.txt python benchmarks/bot_load.py --updates 10000 --concurrency 32 --flooders 10 --flood-updates 1000
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import http.server
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+PROVINCES = ["Drenthe", "Flevoland", "Friesland", "Gelderland", "Groningen", "Utrecht", "Zeeland", "Zuid-Holland"]
+CODES = ["Red", "Orange", "Yellow"]
+WEBHOOK_SECRET = "load-test-secret"
+# Chat ids of the flooding users start here
+FLOODER_ID = 2_000_000
+# Text of the update, with how it is answered and its share of the updates; a burst after a viral alert is mostly /start
+TEXTS = [
+    ("/start", "send", 0.35),
+    ("/help", "send", 0.05),
+    ("/region", "send", 0.1),
+    ("/mute", "send", 0.05),
+    ("/reset", "reply", 0.05),
+    (PROVINCES, "reaction", 0.25),
+    (CODES, "reaction", 0.1),
+    ("hello", "reply", 0.05),
+]
+
+
+def strip_update(update: dict) -> dict:
+    """Update as sent by Telegram, without the expected answer"""
+    return {key: value for key, value in update.items() if key != "answer"}
+
+
+def make_updates(count: int, chat_count: int, flooders: int = 0, flood_updates: int = 0, seed: int = 42) -> typing.List[dict]:
+    """Make synthetic updates of `chat_count` private chats, and of `flooders` chats spamming messages
+
+    Args:
+        count (int): Number of updates of the regular chats
+        chat_count (int): Number of regular chats
+        flooders (int, optional): Number of flooding chats. Defaults to 0.
+        flood_updates (int, optional): Number of updates of every flooding chat. Defaults to 0.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        typing.List[dict]: Updates as returned by getUpdates, with the expected answer under "answer"
+    """
+    rnd = random.Random(seed)
+    chat_ids = [1_000_000 + rnd.randrange(chat_count) for _ in range(count)]
+    chat_ids += [FLOODER_ID + i for i in range(flooders) for _ in range(flood_updates)]
+    rnd.shuffle(chat_ids)
+
+    message_ids: collections.Counter = collections.Counter()
+    updates = []
+
+    for update_id, chat_id in enumerate(chat_ids, 1):
+        message_ids[chat_id] += 1
+        if chat_id >= FLOODER_ID:
+            text, answer = "spam", "reply"
+        else:
+            text, answer, _ = rnd.choices(TEXTS, weights=[weight for _, _, weight in TEXTS])[0]
+            text = rnd.choice(text) if isinstance(text, list) else text
+
+        message: typing.Dict[str, typing.Any] = {
+            "message_id": message_ids[chat_id],
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User", "username": f"user{chat_id}"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        updates.append({"update_id": update_id, "message": message, "answer": answer})
+
+    return updates
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """HTTP stand-in for PostgREST and the Telegram Bot API"""
+
+    daemon_threads = True
+
+    def __init__(self, updates: typing.List[dict], latency: float = 0.0, api_latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.updates = updates
+        # Seconds every Bot API call takes, to mimic the round-trip to Telegram
+        self.latency = latency
+        # Seconds every database API call takes
+        self.api_latency = api_latency
+        self.counters: collections.Counter = collections.Counter()
+        self.lock = threading.Lock()
+        # Time every update was served by getUpdates, and the answers per chat: (time, message id it refers to)
+        self.served: typing.Dict[int, float] = {}
+        self.answers: typing.Dict[int, typing.List[typing.Tuple[float, typing.Optional[int]]]] = collections.defaultdict(list)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def handle_error(self, request, client_address):
+        # The bot closes its connections when polling is stopped
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def get_updates(self, offset: int, limit: int) -> typing.List[dict]:
+        """Serve the updates from the offset, update ids start at 1"""
+        updates = self.updates[max(offset - 1, 0) : max(offset - 1, 0) + limit]
+        now = time.perf_counter()
+        with self.lock:
+            for update in updates:
+                self.served.setdefault(update["update_id"], now)
+        return [strip_update(update) for update in updates]
+
+    def answer(self, chat_id: int, message_id: typing.Optional[int]) -> None:
+        """Record an answer of the bot"""
+        with self.lock:
+            self.answers[chat_id].append((time.perf_counter(), message_id))
+            self.counters["answers"] += 1
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: StandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _bot_api(self, method: str, params: dict) -> None:
+        with self.server.lock:
+            self.server.counters[f"bot {method}"] += 1
+
+        match method:
+            case "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_bot"}
+            case "getUpdates":
+                updates = self.server.get_updates(int(params.get("offset", 0)), int(params.get("limit", 100)))
+                if not updates:
+                    time.sleep(0.05)
+                result = updates
+            case "setWebhook" | "deleteWebhook":
+                result = True
+            case _:
+                time.sleep(self.server.latency)
+                chat_id = int(params.get("chat_id", 0))
+                if "reply_parameters" in params:
+                    message_id = json.loads(params["reply_parameters"])["message_id"]
+                else:
+                    message_id = int(params["message_id"]) if "message_id" in params else None
+                self.server.answer(chat_id, message_id)
+
+                if method == "setMessageReaction":
+                    result = True
+                else:
+                    result = {
+                        "message_id": 1,
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "text": params.get("text", ""),
+                    }
+
+        self._reply(200, json.dumps({"ok": True, "result": result}).encode())
+
+    def _handle(self, http_method: str) -> None:
+        url = urllib.parse.urlparse(self.path)
+        body = self._read_body()
+
+        if url.path.startswith("/bot"):
+            params = dict(urllib.parse.parse_qsl(url.query)) | dict(urllib.parse.parse_qsl(body.decode()))
+            self._bot_api(url.path.rsplit("/", 1)[-1], params)
+        else:
+            time.sleep(self.server.api_latency)
+            with self.server.lock:
+                self.server.counters[f"{http_method} {url.path}"] += 1
+            self._reply(201 if http_method == "POST" else 204)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+
+def load_bot(api_url: str) -> typing.Any:
+    """Import the bot module, configured to use the stand-in"""
+    os.environ["API_URL"] = api_url
+    os.environ.pop("REDIS_CHANNEL", None)
+    if str(ROOT / "knmi_bot") not in sys.path:
+        sys.path.insert(0, str(ROOT / "knmi_bot"))
+
+    return importlib.import_module("bot")
+
+
+def generate_updates(
+    url: str, updates: typing.List[dict], connections: int
+) -> typing.Tuple[collections.Counter, typing.Dict[int, float]]:
+    """Post the updates to the webhook like Telegram, the updates of a chat one after the other over one connection
+
+    Runs in its own process, so the generator doesn't compete with the bot for the interpreter. Refused updates (503)
+    are posted again after 100 ms. Also posts an update with a wrong secret token first.
+
+    Returns:
+        typing.Tuple[collections.Counter, typing.Dict[int, float]]: Number of responses per status, time every update
+            was posted (time.perf_counter, the same clock in every process)
+    """
+    return asyncio.run(post_updates(url, updates, connections))
+
+
+async def post_updates(
+    url: str, updates: typing.List[dict], connections: int
+) -> typing.Tuple[collections.Counter, typing.Dict[int, float]]:
+    import aiohttp  # ty: ignore[unresolved-import]
+
+    statuses: collections.Counter = collections.Counter()
+    served: typing.Dict[int, float] = {}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections)) as session:
+        async with session.post(url, json=strip_update(updates[0]), headers={"X-Telegram-Bot-Api-Secret-Token": "x"}) as r:
+            statuses[r.status] += 1
+
+        async def worker(i: int):
+            for update in updates:
+                if update["message"]["chat"]["id"] % connections != i:
+                    continue
+                served[update["update_id"]] = time.perf_counter()
+                while True:
+                    async with session.post(url, json=strip_update(update), headers=headers) as r:
+                        statuses[r.status] += 1
+                        if r.status != 503:
+                            break
+                    await asyncio.sleep(0.1)
+
+        await asyncio.gather(*(worker(i) for i in range(connections)))
+
+    return statuses, served
+
+
+def percentiles(samples: typing.List[float]) -> str:
+    if not samples:
+        return "-"
+    if len(samples) == 1:
+        return f"{samples[0] * 1000:.1f} ms"
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return f"p50 {q[49] * 1000:.1f} ms, p95 {q[94] * 1000:.1f} ms, p99 {q[98] * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms"
+
+
+async def wait_handled(stand_in: StandIn, rate_limiter: typing.Any, count: int, timeout: float) -> bool:
+    """Wait until every update is answered or shed by the rate limit
+
+    Returns:
+        bool: False on timeout
+    """
+    deadline = time.perf_counter() + timeout
+    while stand_in.counters["answers"] + rate_limiter.counters["local"] + rate_limiter.counters["shared"] < count:
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.005)
+    return True
+
+
+def check_answers(stand_in: StandIn) -> typing.Tuple[typing.List[float], int]:
+    """Match the answers of every chat with its updates, in order
+
+    Every update of a chat without shed updates has an answer, at the same position. The answers of a chat with shed
+    updates are matched by the message they refer to, which has to increase.
+
+    Returns:
+        typing.Tuple[typing.List[float], int]: Seconds from serving an update to its answer, number of answers
+            that don't refer to the update in that position
+    """
+    updates = collections.defaultdict(list)
+    for update in stand_in.updates:
+        updates[update["message"]["chat"]["id"]].append(update)
+
+    latencies = []
+    out_of_order = 0
+    for chat_id, answers in stand_in.answers.items():
+        if len(answers) == len(updates[chat_id]):
+            for update, (answered, message_id) in zip(updates[chat_id], answers):
+                expected = None if update["answer"] == "send" else update["message"]["message_id"]
+                out_of_order += message_id != expected
+                latencies.append(answered - stand_in.served[update["update_id"]])
+        else:
+            by_message_id = {update["message"]["message_id"]: update for update in updates[chat_id]}
+            previous = 0
+            for answered, message_id in answers:
+                out_of_order += message_id is None or message_id <= previous
+                if message_id in by_message_id:
+                    latencies.append(answered - stand_in.served[by_message_id[message_id]["update_id"]])
+                previous = message_id or previous
+
+    return latencies, out_of_order
+
+
+async def run(updates: typing.List[dict], mode: str, concurrency: int, args: argparse.Namespace) -> None:
+    """Handle the updates with `concurrency` handlers at the same time
+
+    Args:
+        updates (typing.List[dict]): Synthetic updates
+        mode (str): How the bot gets the updates, "polling" or "webhook"
+        concurrency (int): Maximum number of handlers running at the same time
+        args (argparse.Namespace): Command line arguments
+    """
+    from telebot import asyncio_helper  # ty: ignore[unresolved-import]
+
+    stand_in = StandIn(updates, args.telegram_latency, args.api_latency)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    asyncio_helper.API_URL = stand_in.url + "/bot{0}/{1}"
+
+    bot_app = load_bot(stand_in.url)
+    bot_app.users.API_BASE = stand_in.url
+    bot_app.logger.remove()
+    # Stopping the polling is logged as an error
+    logging.getLogger("TeleBot").setLevel(logging.CRITICAL)
+    bot_app.scheduler = bot_app.ChatScheduler(concurrency)
+    bot_app.rate_limiter = bot_app.RateLimiter(args.rate_limit, args.rate_window)
+    bot_app.user_cache = bot_app.UserCache(bot_app.users.save_user, flush_interval=args.flush_interval)
+    bot_app.bot = bot_app.create_bot("123456:load")
+
+    await bot_app.users.open_session()
+    bot_app.user_cache.start()
+
+    start = time.perf_counter()
+    statuses = None
+    if mode == "webhook":
+        app = bot_app.webhook.create_app(bot_app.bot, bot_app.scheduler, WEBHOOK_SECRET, max_queued=args.max_queued)
+        sock = socket.create_server(("127.0.0.1", 0))
+        runner = await bot_app.webhook.start(app, sock=sock)
+        url = f"http://127.0.0.1:{sock.getsockname()[1]}/telegram"
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            generator = asyncio.get_running_loop().run_in_executor(pool, generate_updates, url, updates, args.connections)
+            statuses, served = await generator
+        stand_in.served.update(served)
+        posted = time.perf_counter() - start
+    else:
+        polling = asyncio.create_task(bot_app.bot.infinity_polling(timeout=1))
+    finished = await wait_handled(stand_in, bot_app.rate_limiter, len(updates), args.timeout)
+    total = time.perf_counter() - start
+
+    # The last answers are recorded before they are sent back
+    await bot_app.scheduler.join()
+    if mode == "webhook":
+        await bot_app.webhook.stop(app, runner)
+    else:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+    await bot_app.user_cache.stop()
+    await bot_app.users.close_session()
+    await bot_app.bot.close_session()
+    stand_in.shutdown()
+
+    latencies, out_of_order = check_answers(stand_in)
+    answered = stand_in.counters["answers"]
+    chats = len({update["message"]["chat"]["id"] for update in updates})
+
+    print(f"\n{len(updates)} updates of {chats} chats, {mode}, concurrency {concurrency}")
+    if statuses is not None:
+        print(f"  posted   {len(updates)} in {posted:.2f} s, {len(updates) / posted:.0f} updates/s, statuses {dict(statuses)}")
+    shed = bot_app.rate_limiter.counters["local"] + bot_app.rate_limiter.counters["shared"]
+    print(
+        f"  handled  {answered} answered, {shed} shed in {total:.2f} s, {(answered + shed) / total:.0f} updates/s"
+        f"{'' if finished else ' (timed out)'}"
+    )
+    print(f"  latency  {percentiles(latencies)}")
+    print(f"  order    {out_of_order} answers out of order")
+    if args.flooders:
+        flooded = [len(stand_in.answers[chat_id]) for chat_id in range(FLOODER_ID, FLOODER_ID + args.flooders)]
+        print(
+            f"  shed     {dict(bot_app.rate_limiter.counters)}, answers per flooder {min(flooded)}-{max(flooded)} of {args.flood_updates} updates"
+        )
+    print(f"  requests {dict(sorted((k, v) for k, v in stand_in.counters.items() if k != 'answers'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic Telegram updates through knmi_bot")
+    parser.add_argument("--updates", type=int, nargs="+", default=[10_000], help="Numbers of updates")
+    parser.add_argument("--chats", type=int, default=2_000, help="Number of chats sending the updates")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 32], help="Handlers running at the same time")
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], nargs="+", default=["polling"], help="How the bot gets the updates"
+    )
+    parser.add_argument("--connections", type=int, default=40, help="Connections posting to the webhook")
+    parser.add_argument("--max-queued", type=int, default=10_000, help="Queued updates before the webhook refuses them")
+    parser.add_argument("--flooders", type=int, default=0, help="Number of users flooding the bot")
+    parser.add_argument("--flood-updates", type=int, default=500, help="Updates of every flooding user")
+    parser.add_argument("--rate-limit", type=int, default=20, help="Updates per user per window")
+    parser.add_argument("--rate-window", type=float, default=60, help="Length of the rate limit window in seconds")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Seconds per Bot API call")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="Seconds per database API call")
+    parser.add_argument("--flush-interval", type=float, default=1, help="Seconds between user cache flushes")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for all answers")
+    args = parser.parse_args()
+
+    for count in args.updates:
+        updates = make_updates(count, args.chats, args.flooders, args.flood_updates)
+        for mode in args.mode:
+            for concurrency in args.concurrency:
+                asyncio.run(run(updates, mode, concurrency, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Check the HTTP session of the report_checker against a local stand-in of the KNMI hosts with latency and errors
+
+Checks that 429 and 503 answers are retried after their Retry-After, that 5xx answers are retried with backoff until
+the retries run out, and that the connections are reused between requests. Then measures sequential downloads with
+the session against a new connection per request.
+
+    uv run python benchmarks/knmi_download.py
+    uv run python benchmarks/knmi_download.py --latency 0.05 --connect-latency 0.1 --requests 100
+"""
+
+import argparse
+import collections
+import http.server
+import importlib
+import pathlib
+import statistics
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+class KnmiStandIn(http.server.ThreadingHTTPServer):
+    """HTTP stand-in for the KNMI hosts
+
+    GET /report?fail=N&status=S&retry_after=R answers the first N requests of the same query with status S, with a
+    Retry-After of R seconds if given, and then the report. Every answer takes `latency` seconds, every new
+    connection `connect_latency` seconds, like the TCP and TLS handshakes with a remote host.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, report: bytes, latency: float = 0.0, connect_latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), KnmiStandInHandler)
+        self.report = report
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.lock = threading.Lock()
+        # Requests per query, and the client ports of the requests, one port per connection
+        self.requests: collections.Counter = collections.Counter()
+        self.ports: typing.Set[int] = set()
+        self.times: typing.Dict[str, typing.List[float]] = collections.defaultdict(list)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.ports.clear()
+            self.times.clear()
+
+
+class KnmiStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: KnmiStandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.server.connect_latency)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        with self.server.lock:
+            self.server.requests[url.query] += 1
+            self.server.ports.add(self.client_address[1])
+            self.server.times[url.query].append(time.monotonic())
+            count = self.server.requests[url.query]
+
+        time.sleep(self.server.latency)
+        if count <= int(params.get("fail", 0)):
+            self.send_response(int(params.get("status", 503)))
+            if "retry_after" in params:
+                self.send_header("Retry-After", params["retry_after"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(self.server.report)))
+        self.end_headers()
+        self.wfile.write(self.server.report)
+
+
+class Checker:
+    """Runs the checks against the http_session module and collects the results"""
+
+    def __init__(self, stand_in: KnmiStandIn, http_session: typing.Any):
+        self.stand_in = stand_in
+        self.http_session = http_session
+        self.failures = 0
+
+    def check(self, name: str, passed: bool, detail: str = "") -> None:
+        print(f"  {'ok  ' if passed else 'FAIL'} {name}{f': {detail}' if detail else ''}")
+        if not passed:
+            self.failures += 1
+
+    def get(self, session: typing.Any, query: str) -> typing.Tuple[typing.Optional[int], float]:
+        """Get the report, returns the final status (None if the retries ran out) and the seconds it took"""
+        start = time.perf_counter()
+        try:
+            status = session.get(f"{self.stand_in.url}/report?{query}", timeout=5).status_code
+        except self.http_session.requests.exceptions.RetryError:
+            status = None
+        return status, time.perf_counter() - start
+
+    def retry_after(self) -> None:
+        """429 and 503 are retried after the Retry-After of the answer, not after the shorter backoff"""
+        print("Retry-After")
+        session = self.http_session.create_session(backoff_factor=0.01, backoff_jitter=0)
+        for status in (429, 503):
+            self.stand_in.reset()
+            query = f"fail=2&status={status}&retry_after=1"
+            final, elapsed = self.get(session, query)
+            times = self.stand_in.times[query]
+            waits = [later - earlier for earlier, later in zip(times, times[1:])]
+            self.check(
+                f"{status} is retried after its Retry-After",
+                final == 200 and len(times) == 3 and min(waits) >= 0.9,
+                f"{len(times)} requests, waits {', '.join(f'{wait:.2f} s' for wait in waits)}",
+            )
+
+    def backoff(self) -> None:
+        """5xx without Retry-After is retried with exponential backoff, until the retries run out"""
+        print("backoff")
+        session = self.http_session.create_session(retries=3, backoff_factor=0.1, backoff_jitter=0)
+        for status in (500, 502, 504):
+            self.stand_in.reset()
+            query = f"fail=2&status={status}"
+            final, elapsed = self.get(session, query)
+            self.check(f"{status} is retried", final == 200 and self.stand_in.requests[query] == 3, f"{elapsed:.2f} s")
+
+        self.stand_in.reset()
+        query = "fail=10&status=503"
+        final, elapsed = self.get(session, query)
+        self.check(
+            "gives up after the retries",
+            final is None and self.stand_in.requests[query] == 4,
+            f"{self.stand_in.requests[query]} requests in {elapsed:.2f} s",
+        )
+
+        self.stand_in.reset()
+        query = "fail=1&status=404"
+        final, _ = self.get(session, query)
+        self.check("404 is not retried", final == 404 and self.stand_in.requests[query] == 1)
+
+    def connection_reuse(self, count: int) -> None:
+        """Sequential requests, and the retries, go over the same kept-alive connection"""
+        print("connection reuse")
+        session = self.http_session.create_session(backoff_factor=0.01, backoff_jitter=0)
+        self.stand_in.reset()
+        for index in range(count):
+            self.get(session, f"request={index}")
+        self.check(f"{count} requests over one connection", len(self.stand_in.ports) == 1, f"{len(self.stand_in.ports)}")
+
+        self.stand_in.reset()
+        self.get(session, "fail=2&status=503&retry_after=0")
+        self.check("retries over the same connection", len(self.stand_in.ports) == 1, f"{len(self.stand_in.ports)}")
+
+    def measure(self, count: int) -> None:
+        """Sequential downloads with the pooled session and with a new connection per request"""
+        print(
+            f"{count} sequential downloads, {self.stand_in.latency * 1000:.0f} ms latency, "
+            f"{self.stand_in.connect_latency * 1000:.0f} ms per new connection"
+        )
+        requests = self.http_session.requests
+        session = self.http_session.create_session()
+        for name, get in (
+            ("pooled session", lambda index: session.get(f"{self.stand_in.url}/report?run={index}", timeout=5)),
+            ("new connection", lambda index: requests.get(f"{self.stand_in.url}/report?new={index}", timeout=5)),
+        ):
+            self.stand_in.reset()
+            samples = []
+            for index in range(count):
+                start = time.perf_counter()
+                get(index).raise_for_status()
+                samples.append(time.perf_counter() - start)
+            print(
+                f"  {name:<15} p50 {statistics.median(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms, "
+                f"{len(self.stand_in.ports)} connections"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the HTTP session of the report_checker")
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        default=ROOT / "report_checker" / "reports" / "knmi_waarschuwingen_202412290909.xml",
+        help="Report the stand-in serves",
+    )
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds every answer of the stand-in takes")
+    parser.add_argument("--connect-latency", type=float, default=0.05, help="Seconds every new connection takes")
+    parser.add_argument("--requests", type=int, default=50, help="Number of sequential requests")
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(ROOT / "report_checker"))
+    http_session = importlib.import_module("http_session")
+
+    stand_in = KnmiStandIn(args.report.read_bytes(), args.latency, args.connect_latency)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+
+    checker = Checker(stand_in, http_session)
+    checker.retry_after()
+    checker.backoff()
+    checker.connection_reuse(args.requests)
+    checker.measure(args.requests)
+
+    stand_in.shutdown()
+    print(f"\n{checker.failures} checks failed" if checker.failures else "\nAll checks passed")
+    sys.exit(1 if checker.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Replay archived KNMI reports through the checker -> Redis -> notifier pipeline and measure it
+
+PostgREST and the Telegram Bot API are replaced by local stand-ins serving a synthetic user population,
+Redis has to be running (e.g. `docker compose up redis` with the port published, or a local redis-server). Every
+population is replayed in its own process, with its own Redis channel that is deleted afterwards.
+
+    uv run --with-requirements notifier/requirements.txt python benchmarks/replay.py --users 1000 100000 report_checker/reports
+"""
+
+import argparse
+import collections
+import datetime
+import gzip
+import http.server
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import statistics
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+PROVINCES = [
+    "Drenthe",
+    "Flevoland",
+    "Friesland",
+    "Gelderland",
+    "Groningen",
+    "Limburg",
+    "Noord-Brabant",
+    "Noord-Holland",
+    "Overijssel",
+    "Utrecht",
+    "Zeeland",
+    "Zuid-Holland",
+    "Waddenzee",
+    "IJsselmeergebied",
+    "Waddeneilanden",
+]
+CODES = ["red", "orange", "yellow"]
+
+
+def make_users(count: int, seed: int = 42) -> typing.List[dict]:
+    """Make a synthetic user population, spread evenly over the provinces with random mute settings
+
+    Args:
+        count (int): Number of users
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        typing.List[dict]: Users as returned by the /users endpoint
+    """
+    rnd = random.Random(seed)
+    return [
+        {
+            "telegram_id": str(1_000_000 + i),
+            "username": f"user{i}",
+            "region": PROVINCES[i % len(PROVINCES)],
+            "is_deleted": False,
+            **{f"notify_{code}": rnd.random() < 0.9 for code in CODES},
+        }
+        for i in range(count)
+    ]
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """HTTP stand-in for PostgREST and the Telegram Bot API"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, users: typing.List[dict], rate_limit_ratio: float = 0.0, latency: float = 0.0, blocked_ratio: float = 0.0
+    ):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.users = users
+        # Share of the Bot API calls answered with 429 Too Many Requests
+        self.rate_limit_ratio = rate_limit_ratio
+        # Seconds every Bot API call takes, to mimic the round-trip to Telegram
+        self.latency = latency
+        # Share of the chats that blocked the bot, answered with 403 Forbidden
+        self.blocked_ratio = blocked_ratio
+        self.counters: collections.Counter = collections.Counter()
+        self.lock = threading.Lock()
+        self._responses: dict = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def query_users(self, params: dict) -> bytes:
+        """Answer a /users query, supports the eq. and in.() filters the services use"""
+        key = tuple(sorted(params.items()))
+        if key not in self._responses:
+            filters = []
+            for column, value in params.items():
+                operator, _, operand = value.partition(".")
+                if operator == "in":
+                    values = {value.strip('"').lower() for value in operand.strip("()").split(",")}
+                    filters.append(lambda user, c=column, v=values: str(user[c]).lower() in v)
+                elif operator == "eq":
+                    filters.append(lambda user, c=column, v=operand: str(user[c]).lower() == v.lower())
+                elif operator == "gt":
+                    filters.append(lambda user, c=column, v=operand: str(user[c]) > v)
+
+            users = [user for user in self.users if all(f(user) for f in filters)]
+            if "order" in params:
+                users.sort(key=lambda user: str(user[params["order"]]))
+            if "limit" in params:
+                users = users[: int(params["limit"])]
+            self._responses[key] = json.dumps(users).encode()
+
+        return self._responses[key]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: StandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        with self.server.lock:
+            self.server.counters[f"GET {url.path}"] += 1
+
+        if url.path == "/users":
+            self._reply(200, self.server.query_users(params))
+        else:
+            self._reply(200, b"[]")
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self._read_body()
+
+        if url.path.startswith("/bot"):
+            method = url.path.rsplit("/", 1)[-1]
+            time.sleep(self.server.latency)
+            if random.random() < self.server.rate_limit_ratio:
+                with self.server.lock:
+                    self.server.counters["bot 429"] += 1
+                error = {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 1}}
+                self._reply(429, json.dumps(error).encode())
+                return
+
+            params = dict(urllib.parse.parse_qsl(url.query)) | dict(urllib.parse.parse_qsl(body.decode()))
+            if int(params.get("chat_id", 0)) % 1000 < self.server.blocked_ratio * 1000:
+                with self.server.lock:
+                    self.server.counters["bot 403"] += 1
+                error = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+                self._reply(403, json.dumps(error).encode())
+                return
+
+            with self.server.lock:
+                self.server.counters[f"bot {method}"] += 1
+
+            message = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+            self._reply(200, json.dumps({"ok": True, "result": message}).encode())
+        else:
+            with self.server.lock:
+                self.server.counters[f"POST {url.path}"] += 1
+            self._reply(201)
+
+    def do_PATCH(self):
+        url = urllib.parse.urlparse(self.path)
+        self._read_body()
+        with self.server.lock:
+            self.server.counters[f"PATCH {url.path}"] += 1
+        self._reply(204)
+
+
+def find_reports(paths: typing.List[pathlib.Path]) -> typing.List[pathlib.Path]:
+    """Expand directories to the reports in them (.xml and archived .xml.gz), sorted by name"""
+    reports = []
+    for path in paths:
+        if path.is_dir():
+            reports.extend(sorted([*path.glob("*.xml"), *path.glob("*.xml.gz")]))
+        else:
+            reports.append(path)
+    return reports
+
+
+def open_report(path: pathlib.Path) -> io.BufferedIOBase:
+    return gzip.open(path, "rb") if path.suffix == ".gz" else open(path, "rb")
+
+
+def load_services(api_url: str, channel: str) -> typing.Tuple[typing.Any, typing.Any, typing.Any, typing.Any]:
+    """Import the checker and notifier modules, configured to use the stand-ins
+
+    The modules read their configuration on import, so this is called once per process, see main().
+    """
+    os.environ["API_URL"] = api_url
+    os.environ["REDIS_CHANNEL"] = channel
+    for service in ("report_checker", "notifier"):
+        if str(ROOT / service) not in sys.path:
+            sys.path.insert(0, str(ROOT / service))
+
+    knmi_alerts = importlib.import_module("knmi_alerts")
+    alert_diff = importlib.import_module("alert_diff")
+    notifier = importlib.import_module("notifier")
+
+    return knmi_alerts, alert_diff, notifier, sys.modules["alerts"]
+
+
+def percentiles(samples: typing.List[float]) -> str:
+    if not samples:
+        return "-"
+    if len(samples) == 1:
+        return f"{samples[0] * 1000:.1f} ms"
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return f"p50 {q[49] * 1000:.1f} ms, p95 {q[94] * 1000:.1f} ms, p99 {q[98] * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms"
+
+
+def replay(reports: typing.List[pathlib.Path], user_count: int, args: argparse.Namespace) -> None:
+    """Replay the reports through the pipeline against a population of `user_count` users
+
+    Runs in a fresh process per population, the notifier keeps its state (subscribers, alert state) in the module.
+
+    Args:
+        reports (typing.List[pathlib.Path]): Reports to replay, in order
+        user_count (int): Number of synthetic users
+        args (argparse.Namespace): Command line arguments
+    """
+    import redis  # ty: ignore[unresolved-import]
+    import telebot  # ty: ignore[unresolved-import]
+
+    stand_in = StandIn(make_users(user_count), args.rate_limit_ratio, args.telegram_latency, args.blocked_ratio)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    telebot.apihelper.API_URL = stand_in.url + "/bot{0}/{1}"
+
+    channel = f"replay:{user_count}:{datetime.datetime.now():%Y%m%d%H%M%S}"
+    knmi_alerts, alert_diff, notifier, alerts = load_services(stand_in.url, channel)
+    notifier.API_BASE = stand_in.url
+    alerts.API_BASE = stand_in.url
+    notifier.logger.remove()
+    notifier.limiter = sys.modules["delivery"].RateLimiter(args.telegram_rate, args.telegram_chat_rate)
+    notifier.DELIVERY_WORKERS = args.workers
+    notifier.load_subscribers(notifier.subscribers)
+
+    r = redis.Redis(host=args.redis_host, port=args.redis_port, decode_responses=True)
+    bot = telebot.TeleBot("123456:replay")
+    notifier.create_group(r, notifier.CHANGES_STREAM, notifier.DELIVERY_GROUP)
+    notifier.create_group(r, notifier.DELIVERY_STREAM, notifier.DELIVERY_GROUP)
+
+    timings = collections.defaultdict(list)
+    snapshot: dict = {}
+    sequence = 0
+    start = time.perf_counter()
+
+    for _ in range(args.rounds):
+        for path in reports:
+            with open_report(path) as fd:
+                stage_start = time.perf_counter()
+                alerts = alert_diff.normalize_alerts(knmi_alerts.get_alerts(fd, engine="stream"))
+                timings["parse"].append(time.perf_counter() - stage_start)
+
+            changes = alert_diff.diff_alerts(snapshot, alerts)
+            snapshot = alerts
+            if not changes:
+                continue
+
+            sequence += 1
+            stage_start = time.perf_counter()
+            r.xadd(notifier.CHANGES_STREAM, {"data": json.dumps({"sequence": sequence, "alerts": changes})})
+            records = notifier.read_jobs(r, notifier.CHANGES_STREAM, notifier.DELIVERY_GROUP, "replay", 1, 5000)
+            timings["publish"].append(time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            notifier.process_records(r, records)
+            timings["enqueue"].append(time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            while jobs := notifier.read_jobs(
+                r, notifier.DELIVERY_STREAM, notifier.DELIVERY_GROUP, "replay", notifier.DELIVERY_BATCH_SIZE, 1
+            ):
+                notifier.deliver_jobs(bot, r, jobs)
+            notifier.flush_soft_deletes()
+            timings["deliver"].append(time.perf_counter() - stage_start)
+
+    total = time.perf_counter() - start
+    sent = stand_in.counters["bot sendMessage"]
+
+    print(f"\n{user_count} users, {len(reports)} reports x {args.rounds} rounds, {sequence} published changes")
+    for stage in ("parse", "publish", "enqueue", "deliver"):
+        print(f"  {stage:<8} {percentiles(timings[stage])}")
+    print(f"  messages {sent} in {total:.2f} s, {sent / total:.0f} msg/s")
+    print(f"  requests {dict(sorted(stand_in.counters.items()))}")
+
+    # Streams, alert state, applied sequence, pending reports and the delivery markers of the channel
+    keys = list(r.scan_iter(match=f"{channel}:*", count=10_000))
+    for index in range(0, len(keys), 10_000):
+        r.delete(*keys[index : index + 10_000])
+    stand_in.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay KNMI reports through the checker -> notifier pipeline")
+    parser.add_argument(
+        "reports",
+        nargs="*",
+        type=pathlib.Path,
+        default=[ROOT / "report_checker" / "reports"],
+        help="Reports or directories with reports (.xml, archived .xml.gz)",
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 100_000, 1_000_000], help="Population sizes")
+    parser.add_argument("--rounds", type=int, default=1, help="Number of times the reports are replayed")
+    parser.add_argument("--redis-host", default="localhost", help="Redis host")
+    parser.add_argument("--redis-port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent Telegram senders")
+    parser.add_argument("--telegram-rate", type=float, default=0, help="Global messages per second, 0 is unlimited")
+    parser.add_argument("--telegram-chat-rate", type=float, default=1, help="Messages per second per chat")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="Seconds per Bot API call")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="Share of Bot API calls answered with 429")
+    parser.add_argument("--blocked-ratio", type=float, default=0, help="Share of chats that blocked the bot (403)")
+    args = parser.parse_args()
+
+    reports = find_reports(args.reports)
+    context = multiprocessing.get_context("spawn")
+    for user_count in args.users:
+        process = context.Process(target=replay, args=(reports, user_count, args))
+        process.start()
+        process.join()
+        if process.exitcode:
+            sys.exit(process.exitcode)
+
+
+if __name__ == "__main__":
+    main()
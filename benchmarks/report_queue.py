@@ -0,0 +1,296 @@
+"""Check the report queue of the report_checker: drop-oldest backpressure, ack on failure and latest-wins ordering
+
+The MQTT client is replaced by a fake that records the acks, the KNMI API and download host by a local stand-in
+serving the sample reports. The notifications go through the same path as on_message, the reports are parsed in the
+parse pool. Redis is an in-process fakeredis unless `--redis-port` is given.
+
+    uv run --with-requirements report_checker/requirements.txt --with fakeredis python benchmarks/report_queue.py
+    uv run --with-requirements report_checker/requirements.txt python benchmarks/report_queue.py --pool thread --redis-port 6379
+"""
+
+import argparse
+import collections
+import http.server
+import importlib
+import io
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+BROKEN_REPORT = b"<not a report"
+
+
+class FakeClient:
+    """MQTT client that records the acknowledged messages"""
+
+    def __init__(self):
+        self.acks: collections.Counter = collections.Counter()
+        self.lock = threading.Lock()
+
+    def ack(self, mid: int, qos: int) -> None:
+        with self.lock:
+            self.acks[mid] += 1
+
+
+class KnmiStandIn(http.server.ThreadingHTTPServer):
+    """HTTP stand-in for the KNMI open data API and its download host
+
+    /files/{filename}/url resolves to /download/{filename}, which serves the content set for the filename. Downloads
+    of the filenames in `held` wait until `release` is set.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), KnmiStandInHandler)
+        self.reports: typing.Dict[str, bytes] = {}
+        self.held: typing.Set[str] = set()
+        self.release = threading.Event()
+        self.started = threading.Event()
+        # Seconds every download takes
+        self.latency = 0.0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class KnmiStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: KnmiStandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urllib.parse.urlparse(self.path).path.strip("/").split("/")
+        if parts[0] == "files" and parts[1] in self.server.reports:
+            self._reply(200, f'{{"temporaryDownloadUrl": "{self.server.url}/download/{parts[1]}"}}'.encode())
+        elif parts[0] == "download" and parts[1] in self.server.reports:
+            if parts[1] in self.server.held:
+                self.server.started.set()
+                self.server.release.wait()
+            time.sleep(self.server.latency)
+            self._reply(200, self.server.reports[parts[1]], "application/xml")
+        else:
+            self._reply(404, b"{}")
+
+
+class Checker:
+    """Runs the scenarios against the report_checker module and collects the results"""
+
+    def __init__(self, app: typing.Any, r: typing.Any, stand_in: KnmiStandIn, samples: typing.List[bytes]):
+        self.app = app
+        self.r = r
+        self.stand_in = stand_in
+        self.samples = samples
+        self.client = FakeClient()
+        self.failures = 0
+        self.minute = 0
+        # Filenames in the order the worker processed them
+        self.processed: typing.List[str] = []
+
+        process_message = app.process_message
+
+        def record(message: dict, pool=None):
+            self.processed.append(message["data"]["filename"])
+            return process_message(message, pool)
+
+        app.process_message = record
+
+    def notification(self, content: bytes) -> dict:
+        """Notification of a new report with the content, every notification is issued a minute after the previous"""
+        self.minute += 1
+        filename = f"knmi_waarschuwingen_{202501010000 + self.minute // 60 * 100 + self.minute % 60}.xml"
+        self.stand_in.reports[filename] = content
+        return {"data": {"filename": filename, "url": f"{self.stand_in.url}/files/{filename}/url"}}
+
+    def reset(self) -> FakeClient:
+        """Start a scenario with an empty state, as after a first start"""
+        self.clear_redis()
+        self.app.newest_report_time = None
+        self.app.report_stats.clear()
+        self.processed.clear()
+        self.client.acks.clear()
+        return self.client
+
+    def clear_redis(self) -> None:
+        app = self.app
+        self.r.delete(
+            app.REPORT_CACHE_KEY,
+            app.LAST_ALERTS_HASH_KEY,
+            app.LAST_ALERTS_KEY,
+            app.SEQUENCE_KEY,
+            app.NEWEST_REPORT_KEY,
+            app.REPORT_STATS_KEY,
+            app.CHANGES_STREAM,
+        )
+
+    def check(self, name: str, passed: bool, detail: str = "") -> None:
+        print(f"  {'ok  ' if passed else 'FAIL'} {name}{f': {detail}' if detail else ''}")
+        if not passed:
+            self.failures += 1
+
+    def expected_alerts(self, content: bytes) -> dict:
+        return self.app.normalize_alerts(self.app.get_alerts(io.BytesIO(content)))
+
+    def last_alerts(self) -> dict:
+        return self.app.get_last_alerts(self.r, self.app.LAST_ALERTS_KEY)
+
+    def drop_oldest(self) -> None:
+        """A burst arrives while the worker is busy: the oldest queued reports are dropped, only the newest is processed"""
+        print("drop-oldest backpressure")
+        client = self.reset()
+        queue_size = self.app.report_queue.maxsize
+        burst = [self.notification(self.samples[i % len(self.samples)]) for i in range(queue_size + 6)]
+
+        self.stand_in.held = {burst[0]["data"]["filename"]}
+        self.stand_in.release.clear()
+        self.stand_in.started.clear()
+        self.app.enqueue_report(client, burst[0], 1, 1)
+        self.stand_in.started.wait(10)
+
+        for mid, message in enumerate(burst[1:], 2):
+            self.app.enqueue_report(client, message, mid, 1)
+        dropped = len(burst) - 1 - queue_size
+        self.check("queue is bounded", self.app.report_queue.qsize() == queue_size, f"{self.app.report_queue.qsize()} queued")
+        self.check("dropped reports are acked on arrival", sum(client.acks.values()) == dropped, f"{dict(client.acks)}")
+
+        self.stand_in.release.set()
+        self.app.report_queue.join()
+        self.stand_in.held = set()
+
+        newest = burst[-1]["data"]["filename"]
+        self.check("every message is acked once", client.acks == {mid: 1 for mid in range(1, len(burst) + 1)})
+        self.check(
+            "only the running and the newest report are processed",
+            self.processed == [burst[0]["data"]["filename"], newest],
+            f"{self.processed}",
+        )
+        self.check("the newest report is published", self.last_alerts() == self.expected_alerts(self.stand_in.reports[newest]))
+        self.check(
+            "stats",
+            dict(self.app.report_stats) == {"processed": 2, "coalesced": len(burst) - 2},
+            f"{dict(self.app.report_stats)}",
+        )
+
+    def ack_on_failure(self) -> None:
+        """A broken report is acked and counted, the worker goes on with the next report"""
+        print("ack on failure")
+        client = self.reset()
+        good, broken, newer = (
+            self.notification(self.samples[0]),
+            self.notification(BROKEN_REPORT),
+            self.notification(self.samples[-1]),
+        )
+
+        for mid, message in enumerate([good, broken], 1):
+            self.app.enqueue_report(client, message, mid, 1)
+            self.app.report_queue.join()
+        self.check("the broken report is acked", client.acks == {1: 1, 2: 1}, f"{dict(client.acks)}")
+        self.check("the broken report is counted", self.app.report_stats["failed"] == 1, f"{dict(self.app.report_stats)}")
+        self.check("the alerts of the last good report stay", self.last_alerts() == self.expected_alerts(self.samples[0]))
+
+        self.app.enqueue_report(client, newer, 3, 1)
+        self.app.report_queue.join()
+        self.check("the worker goes on", client.acks == {1: 1, 2: 1, 3: 1}, f"{dict(client.acks)}")
+        self.check("the next report is published", self.last_alerts() == self.expected_alerts(self.samples[-1]))
+
+    def latest_wins(self, rounds: int) -> None:
+        """Notifications arrive out of order while reports are processed, e.g. a backlog replay after a reconnect: the
+        processed reports are published in issue order and the newest report is published last"""
+        print("latest-wins ordering")
+        processed = 0
+        for round_ in range(rounds):
+            client = self.reset()
+            burst = [self.notification(self.samples[i % len(self.samples)]) for i in range(len(self.samples) * 4)]
+            order = list(range(len(burst)))
+            rnd = random.Random(round_)
+            rnd.shuffle(order)
+
+            for mid in order:
+                self.app.enqueue_report(client, burst[mid], mid, 1)
+                time.sleep(rnd.random() * 2 * self.stand_in.latency)
+            self.app.report_queue.join()
+            processed += len(self.processed)
+
+            newest = burst[-1]["data"]["filename"]
+            passed = (
+                client.acks == {mid: 1 for mid in range(len(burst))}
+                and self.processed == sorted(self.processed)
+                and self.processed[-1] == newest
+                and self.last_alerts() == self.expected_alerts(self.stand_in.reports[newest])
+            )
+            if not passed:
+                self.check(f"round {round_ + 1}", passed, f"processed {self.processed}, acks {dict(client.acks)}")
+                return
+
+        self.check(
+            f"{rounds} rounds: every message acked once, processed in issue order, newest published",
+            True,
+            f"{processed} of {rounds * len(burst)} reports processed",
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the report queue of the report_checker")
+    parser.add_argument("--pool", choices=["process", "thread"], default="process", help="Parse pool, see PARSE_POOL")
+    parser.add_argument("--rounds", type=int, default=20, help="Shuffled bursts of the latest-wins check")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds every report download takes")
+    parser.add_argument("--redis-host", default="localhost", help="Redis host")
+    parser.add_argument("--redis-port", type=int, default=None, help="Redis port, fakeredis if not given")
+    args = parser.parse_args()
+
+    os.environ["REDIS_CHANNEL"] = "report-queue-check"
+    os.environ["PARSE_POOL"] = args.pool
+    os.environ.pop("REPORT_ARCHIVE_DIR", None)
+    sys.path.insert(0, str(ROOT / "report_checker"))
+    app = importlib.import_module("app")
+    app.logger.setLevel("CRITICAL")
+
+    if args.redis_port is None:
+        import fakeredis  # ty: ignore[unresolved-import]
+
+        r = fakeredis.FakeRedis()
+    else:
+        import redis  # ty: ignore[unresolved-import]
+
+        r = redis.Redis(host=args.redis_host, port=args.redis_port)
+
+    stand_in = KnmiStandIn()
+    stand_in.latency = args.latency
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+
+    app.set_clients(app.Clients("token", r, app.create_session()))
+    pool = app.create_parse_pool()
+
+    samples = [path.read_bytes() for path in sorted((ROOT / "report_checker" / "reports").glob("knmi_waarschuwingen_*.xml"))]
+    checker = Checker(app, r, stand_in, samples)
+    threading.Thread(target=app.process_reports, args=(checker.client, pool), name="report-worker", daemon=True).start()
+
+    checker.drop_oldest()
+    checker.ack_on_failure()
+    checker.latest_wins(args.rounds)
+
+    checker.clear_redis()
+    pool.shutdown()
+    stand_in.shutdown()
+    print(f"\n{checker.failures} checks failed" if checker.failures else "\nAll checks passed")
+    sys.exit(1 if checker.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,66 @@
+import asyncio
+import functools
+import os
+import signal
+import typing
+
 import telebot  # ty: ignore[unresolved-import]
+import users
+import webhook
+from chat_scheduler import ChatScheduler
 from get_docker_secret import get_docker_secret
 from loguru import logger
-from users import create_or_update_user, soft_delete_user, update_user_mute_code, update_user_region
+from rate_limit import RateLimiter
+from telebot import asyncio_helper  # ty: ignore[unresolved-import]
+from telebot.async_telebot import AsyncTeleBot  # ty: ignore[unresolved-import]
+from user_cache import UserCache
+
+# User changes are written behind, see UserCache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "1"))
+# Updates handled at the same time, the updates of a chat are handled in order, see ChatScheduler
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "32"))
+# Seconds to finish the queued updates on shutdown
+BOT_SHUTDOWN_TIMEOUT = float(os.getenv("BOT_SHUTDOWN_TIMEOUT", "5"))
+# How updates are received: "polling" (getUpdates) or "webhook" (Telegram posts them, see webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Updates per user per window, more are dropped before any I/O, see RateLimiter
+RATE_LIMIT = int(os.getenv("RATE_LIMIT", "20"))
+RATE_LIMIT_WINDOW = float(os.getenv("RATE_LIMIT_WINDOW", "60"))
+# Share the rate limit between the replicas in Redis (needs REDIS_CHANNEL)
+RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "false").lower() == "true"
+# Port of the probes and the metrics when polling, not served if empty; the webhook server serves them too
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+
+# Public URL of the webhook server, e.g. https://bot.example.com, the webhook is set at startup if given. Replicas
+# behind a load balancer share the URL and the secret token (telegram_webhook_secret)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Connections Telegram opens to the webhook at the same time (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Updates refused with 503 above this many queued updates, Telegram sends them again
+WEBHOOK_MAX_QUEUED = int(os.getenv("WEBHOOK_MAX_QUEUED", "10000"))
+
+user_cache = UserCache(users.save_user, USER_CACHE_SIZE, USER_FLUSH_INTERVAL, users.API_POOL_SIZE)
+scheduler = ChatScheduler(BOT_CONCURRENCY)
+rate_limiter = RateLimiter(
+    RATE_LIMIT,
+    RATE_LIMIT_WINDOW,
+    users.redis_client if RATE_LIMIT_SHARED else None,
+    f"{users.REDIS_CHANNEL}:rate_limit",
+)
+bot: typing.Optional[AsyncTeleBot] = None
+
+
+class MessageHandler(typing.NamedTuple):
+    """Message handler of the bot, see AsyncTeleBot.register_message_handler"""
+
+    callback: typing.Callable[..., typing.Awaitable]
+    commands: typing.Optional[typing.List[str]] = None
+    func: typing.Optional[typing.Callable[[telebot.types.Message], bool]] = None
+
 
 LIST_OF_PROVINCES = [
     "Drenthe",
@@ -28,11 +87,11 @@ LIST_OF_CODES = [
 ]
 
 
-def send_message_or_soft_delete(bot: telebot.TeleBot, telegram_id: str, message: str, **kwargs) -> bool:
+async def send_message_or_soft_delete(bot: AsyncTeleBot, telegram_id: str, message: str, **kwargs) -> bool:
     """Send message to the user or soft delete the user
 
     Args:
-        bot (telebot.TeleBot): Telegram bot
+        bot (AsyncTeleBot): Telegram bot
         user (dict): User information
         message (str): Message to send
 
@@ -40,19 +99,20 @@ def send_message_or_soft_delete(bot: telebot.TeleBot, telegram_id: str, message:
         bool: True if message is sent successfully, False otherwise
     """
     try:
-        bot.send_message(telegram_id, message, parse_mode="Markdown", **kwargs)
+        await bot.send_message(telegram_id, message, parse_mode="Markdown", **kwargs)
         return True
-    except telebot.apihelper.ApiException as e:
+    except asyncio_helper.ApiException as e:
         logger.error(f"Error: {e}")
-        soft_delete_user(telegram_id)
+        # Through the cache, so a buffered change of the user written later doesn't undo it
+        user_cache.update({"telegram_id": telegram_id, "is_deleted": True}, force=True)
         return False
 
 
-def send_reply_or_soft_delete(bot: telebot.TeleBot, message: telebot.types.Message, reply: str, **kwargs) -> bool:
+async def send_reply_or_soft_delete(bot: AsyncTeleBot, message: telebot.types.Message, reply: str, **kwargs) -> bool:
     """Send reply to the user or soft delete the user
 
     Args:
-        bot (telebot.TeleBot): Telegram bot
+        bot (AsyncTeleBot): Telegram bot
         message (telebot.types.Message): Telegram message
         reply (str): Reply to send
 
@@ -60,19 +120,19 @@ def send_reply_or_soft_delete(bot: telebot.TeleBot, message: telebot.types.Messa
         bool: True if message is sent successfully, False otherwise
     """
     try:
-        bot.reply_to(message, reply, **kwargs)
+        await bot.reply_to(message, reply, **kwargs)
         return True
-    except telebot.apihelper.ApiException as e:
+    except asyncio_helper.ApiException as e:
         logger.error(f"Error: {e}")
-        soft_delete_user(message.from_user.id)
+        user_cache.update({"telegram_id": message.from_user.id, "is_deleted": True}, force=True)
         return False
 
 
-def send_reaction_or_soft_delete(bot: telebot.TeleBot, chat_id: str, message_id: str, reactions: list, **kwargs) -> bool:
+async def send_reaction_or_soft_delete(bot: AsyncTeleBot, chat_id: str, message_id: str, reactions: list, **kwargs) -> bool:
     """Send reaction to the message or soft delete the user
 
     Args:
-        bot (telebot.TeleBot): Telegram bot
+        bot (AsyncTeleBot): Telegram bot
         chat_id (str): Chat id of the user
         message_id (str): Message id
         reactions (list): List of reactions
@@ -81,22 +141,24 @@ def send_reaction_or_soft_delete(bot: telebot.TeleBot, chat_id: str, message_id:
         bool: True if message is sent successfully, False otherwise
     """
     try:
-        bot.set_message_reaction(chat_id, message_id, reactions, **kwargs)
+        await bot.set_message_reaction(chat_id, message_id, reactions, **kwargs)
         return True
-    except telebot.apihelper.ApiException as e:
+    except asyncio_helper.ApiException as e:
         logger.error(f"Error: {e}")
-        soft_delete_user(chat_id)
+        user_cache.update({"telegram_id": chat_id, "is_deleted": True}, force=True)
         return False
 
 
-def send_welcome_command(message: telebot.types.Message):
+async def send_welcome_command(message: telebot.types.Message):
     """Send welcome message
 
     Args:
         message (telebot.types.Message): Telegram message
     """
-    create_or_update_user(
-        {"telegram_id": message.from_user.id, "is_deleted": False, "username": message.from_user.username or "undefined"}
+    # Forced, the notifier may have soft deleted the user without the cache knowing
+    user_cache.update(
+        {"telegram_id": message.from_user.id, "is_deleted": False, "username": message.from_user.username or "undefined"},
+        force=True,
     )
 
     welcome_message = f"""
@@ -108,10 +170,10 @@ Welcome {message.from_user.username}! Please use the following commands:
 This will help me to send alerts based on your preferences.
 """
 
-    send_message_or_soft_delete(bot, message.chat.id, welcome_message)
+    await send_message_or_soft_delete(bot, message.chat.id, welcome_message)
 
 
-def send_help_command(message: telebot.types.Message):
+async def send_help_command(message: telebot.types.Message):
     """Send help message
 
     Args:
@@ -125,10 +187,10 @@ Please use the following commands:
 - /reset: Reset all settings for notifications
 """
 
-    send_message_or_soft_delete(bot, message.chat.id, help_message)
+    await send_message_or_soft_delete(bot, message.chat.id, help_message)
 
 
-def set_region_command(message: telebot.types.Message):
+async def set_region_command(message: telebot.types.Message):
     """Set the region for the user
 
     Args:
@@ -139,10 +201,10 @@ def set_region_command(message: telebot.types.Message):
     keyboard.add(*[telebot.types.KeyboardButton(province) for province in LIST_OF_PROVINCES[: len(LIST_OF_PROVINCES) // 2]])
     keyboard.add(*[telebot.types.KeyboardButton(province) for province in LIST_OF_PROVINCES[len(LIST_OF_PROVINCES) // 2 :]])
 
-    send_message_or_soft_delete(bot, message.chat.id, "Please select your region", reply_markup=keyboard)
+    await send_message_or_soft_delete(bot, message.chat.id, "Please select your region", reply_markup=keyboard)
 
 
-def set_mute_code_command(message: telebot.types.Message):
+async def set_mute_code_command(message: telebot.types.Message):
     """Mute the alert code
 
     Args:
@@ -152,66 +214,190 @@ def set_mute_code_command(message: telebot.types.Message):
 
     keyboard.add(*[telebot.types.KeyboardButton(code) for code in LIST_OF_CODES])
 
-    send_message_or_soft_delete(bot, message.chat.id, "Please select the code you want to mute", reply_markup=keyboard)
+    await send_message_or_soft_delete(bot, message.chat.id, "Please select the code you want to mute", reply_markup=keyboard)
 
 
-def reset_mute_code_command(message: telebot.types.Message):
+async def reset_mute_code_command(message: telebot.types.Message):
     """Reset the mute code
 
     Args:
         message (telebot.types.Message): Telegram message
     """
 
-    for code in LIST_OF_CODES:
-        update_user_mute_code(message.from_user.id, code, True)
+    user_cache.update(
+        {
+            "telegram_id": message.from_user.id,
+            "username": message.from_user.username or "undefined",
+            **{f"notify_{code.lower()}": True for code in LIST_OF_CODES},
+        }
+    )
 
-    send_reply_or_soft_delete(bot, message, "Mute code reset successfully \U0001f44d")
+    await send_reply_or_soft_delete(bot, message, "Mute code reset successfully \U0001f44d")
 
 
-def catch_all_messages(message: telebot.types.Message):
+async def catch_all_messages(message: telebot.types.Message):
     """Echo all messages
 
     Args:
         message (telebot.types.Message): Telegram message
     """
-    create_or_update_user({"telegram_id": message.from_user.id, "username": message.from_user.username or "undefined"})
+    user_cache.update({"telegram_id": message.from_user.id, "username": message.from_user.username or "undefined"})
 
     if message.text in LIST_OF_PROVINCES:
-        send_reaction_or_soft_delete(
+        await send_reaction_or_soft_delete(
             bot, message.chat.id, message.id, [telebot.types.ReactionTypeEmoji("\U0001f44d")], is_big=False
         )
-        update_user_region(message.from_user.id, message.text)
+        user_cache.update({"telegram_id": message.from_user.id, "region": message.text})
     elif message.text in LIST_OF_CODES:
-        send_reaction_or_soft_delete(
+        await send_reaction_or_soft_delete(
             bot, message.chat.id, message.id, [telebot.types.ReactionTypeEmoji("\U0001f44d")], is_big=False
         )
-        update_user_mute_code(message.from_user.id, message.text)
+        user_cache.update({"telegram_id": message.from_user.id, f"notify_{message.text.lower()}": False})
     else:
-        send_reply_or_soft_delete(
+        await send_reply_or_soft_delete(
             bot, message, "I don't understand this command \U0001f62d. Please use /help to see the list of commands."
         )
 
 
-if __name__ == "__main__":
-    while True:
+def limit_rate(handler: typing.Callable[..., typing.Awaitable]) -> typing.Callable[..., typing.Awaitable]:
+    """Wrap a message handler, so it's run by the scheduler unless the user is over the rate limit
+
+    The in-memory limit is checked before the update is queued. The shared limit is checked in the turn of the chat,
+    so waiting for Redis doesn't change the order of the updates of a chat.
+
+    Args:
+        handler (typing.Callable[..., typing.Awaitable]): Handler of a telebot.types.Message
+
+    Returns:
+        typing.Callable[..., typing.Awaitable]: Handler to register
+    """
+
+    @functools.wraps(handler)
+    async def run_shared(message: telebot.types.Message):
+        if await rate_limiter.allow_shared(message.from_user.id):
+            return await handler(message)
+
+    scheduled = scheduler.wrap(run_shared)
+
+    @functools.wraps(handler)
+    async def run(message: telebot.types.Message):
+        if rate_limiter.allow(message.from_user.id):
+            return await scheduled(message)
+
+    return run
+
+
+def create_bot(token: str) -> AsyncTeleBot:
+    """Create the bot with the handlers, run by the scheduler within the rate limit
+
+    Args:
+        token (str): Telegram bot token
+
+    Returns:
+        AsyncTeleBot: Telegram bot
+    """
+    async_bot = AsyncTeleBot(token)
+
+    handlers = [
+        MessageHandler(send_welcome_command, commands=["start"]),
+        MessageHandler(send_help_command, commands=["help"]),
+        MessageHandler(set_region_command, commands=["region"]),
+        MessageHandler(set_mute_code_command, commands=["mute"]),
+        MessageHandler(reset_mute_code_command, commands=["reset"]),
+        MessageHandler(catch_all_messages, func=lambda message: True),
+    ]
+
+    for handler in handlers:
+        async_bot.register_message_handler(limit_rate(handler.callback), commands=handler.commands, func=handler.func)
+
+    return async_bot
+
+
+async def run_polling(bot: AsyncTeleBot, stopping: asyncio.Event):
+    """Get the updates with long polling until stopping is set
+
+    Args:
+        bot (AsyncTeleBot): Telegram bot
+        stopping (asyncio.Event): Set to stop
+    """
+    # getUpdates is refused while a webhook is set
+    await bot.delete_webhook()
+
+    if METRICS_PORT:
+        app = webhook.create_app(bot, scheduler, None, metrics=rate_limiter.metrics)
+        runner = await webhook.start(app, WEBHOOK_HOST, int(METRICS_PORT))
+
+    try:
+        while not stopping.is_set():
+            polling = asyncio.create_task(bot.infinity_polling())
+            stopped = asyncio.create_task(stopping.wait())
+            await asyncio.wait({polling, stopped}, return_when=asyncio.FIRST_COMPLETED)
+
+            stopped.cancel()
+            polling.cancel()
+            for result in await asyncio.gather(polling, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(f"Error: {result}")
+                    await asyncio.sleep(1)
+    finally:
+        if METRICS_PORT:
+            await webhook.stop(app, runner)
+
+
+async def run_webhook(bot: AsyncTeleBot, stopping: asyncio.Event):
+    """Receive the updates with the webhook server until stopping is set
+
+    Args:
+        bot (AsyncTeleBot): Telegram bot
+        stopping (asyncio.Event): Set to stop
+    """
+    secret_token = get_docker_secret("telegram_webhook_secret")
+    if not secret_token:
+        raise ValueError("The telegram_webhook_secret secret is needed in webhook mode")
+
+    app = webhook.create_app(bot, scheduler, secret_token, WEBHOOK_PATH, WEBHOOK_MAX_QUEUED, rate_limiter.metrics)
+    runner = await webhook.start(app, WEBHOOK_HOST, WEBHOOK_PORT)
+
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=secret_token,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        await stopping.wait()
+    finally:
+        await webhook.stop(app, runner)
+
+
+async def main():
+    global bot
+
+    # Docker stops the container with SIGTERM, receiving updates stops and the buffered user changes are written
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
+
+    logger.info(f"Starting bot ({BOT_MODE})")
+    bot = create_bot(get_docker_secret("telegram_bot_token"))
+
+    await users.open_session()
+    user_cache.start()
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, stopping)
+        else:
+            await run_polling(bot, stopping)
+    finally:
         try:
-            logger.info("Starting bot")
-
-            bot = telebot.TeleBot(get_docker_secret("telegram_bot_token"))
-
-            handlers = [
-                {"commands": ["start"], "callback": send_welcome_command},
-                {"commands": ["help"], "callback": send_help_command},
-                {"commands": ["region"], "callback": set_region_command},
-                {"commands": ["mute"], "callback": set_mute_code_command},
-                {"commands": ["reset"], "callback": reset_mute_code_command},
-                {"func": lambda message: True, "callback": catch_all_messages},
-            ]
-
-            for handler in handlers:
-                bot.register_message_handler(**handler)
-
-            bot.infinity_polling()
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            continue
+            await asyncio.wait_for(scheduler.join(), BOT_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(scheduler)} updates not handled on shutdown")
+        await user_cache.stop()
+        await users.close_session()
+        await bot.close_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import typing
+
+
+class ChatScheduler:
+    """Runs the handlers of the updates concurrently, with bounded parallelism and in order per chat
+
+    Every chat has a lock, so the updates of a chat are handled one after the other. Locks are FIFO and handlers
+    are started in the order of the updates, so they are handled in that order. At most `concurrency` handlers
+    run at the same time, a chat waiting for its previous update doesn't take a slot.
+    """
+
+    def __init__(self, concurrency: int = 32):
+        """
+        Args:
+            concurrency (int, optional): Maximum number of handlers running at the same time. Defaults to 32.
+        """
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._locks: typing.Dict[int, asyncio.Lock] = {}
+        self._queued: typing.Dict[int, int] = {}
+        self._count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def __len__(self) -> int:
+        """Number of updates queued or being handled"""
+        return self._count
+
+    async def run(self, chat_id: int, handler: typing.Callable[..., typing.Awaitable], *args) -> typing.Any:
+        """Run the handler after the previous handlers of the chat, once a slot is free
+
+        Args:
+            chat_id (int): Chat of the update
+            handler (typing.Callable[..., typing.Awaitable]): Handler
+            *args: Arguments of the handler
+
+        Returns:
+            typing.Any: Result of the handler
+        """
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._queued[chat_id] = self._queued.get(chat_id, 0) + 1
+        self._count += 1
+        self._idle.clear()
+
+        try:
+            async with lock, self._semaphore:
+                return await handler(*args)
+        finally:
+            self._count -= 1
+            self._queued[chat_id] -= 1
+            if not self._queued[chat_id]:
+                # Nothing queued for the chat, so nobody waits for the lock
+                del self._queued[chat_id]
+                del self._locks[chat_id]
+            if not self._queued:
+                self._idle.set()
+
+    def wrap(self, handler: typing.Callable[..., typing.Awaitable]) -> typing.Callable[..., typing.Awaitable]:
+        """Wrap a message handler, so it's run by the scheduler
+
+        Args:
+            handler (typing.Callable[..., typing.Awaitable]): Handler of a telebot.types.Message
+
+        Returns:
+            typing.Callable[..., typing.Awaitable]: Handler to register
+        """
+
+        @functools.wraps(handler)
+        async def run(message):
+            return await self.run(message.chat.id, handler, message)
+
+        return run
+
+    async def join(self) -> None:
+        """Wait until all queued updates are handled"""
+        await self._idle.wait()
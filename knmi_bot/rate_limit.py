@@ -0,0 +1,182 @@
+import collections
+import time
+import typing
+
+import redis  # ty: ignore[unresolved-import]
+import redis.asyncio  # ty: ignore[unresolved-import]
+from loguru import logger
+
+
+class SlidingWindow:
+    """In-memory sliding window rate limit per key, e.g. per Telegram user
+
+    Approximates a sliding window with two fixed windows: the count of the previous window is weighted by the part
+    of it that still overlaps the sliding window. Every attempt is counted, also when it's over the limit, so a user
+    that keeps flooding stays over it. Keeps 3 numbers per key, keys of older windows are dropped once per window.
+    """
+
+    def __init__(self, limit: int, window: float, clock: typing.Callable[[], float] = time.monotonic):
+        """
+        Args:
+            limit (int): Maximum number of attempts per window
+            window (float): Length of the window in seconds
+            clock (typing.Callable[[], float], optional): Clock in seconds. Defaults to time.monotonic.
+        """
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        # Key -> [index of the current window, count of the current window, count of the previous window]
+        self._counts: typing.Dict[typing.Hashable, typing.List[int]] = {}
+        self._cleaned = 0
+
+    def __len__(self) -> int:
+        """Number of keys counted"""
+        return len(self._counts)
+
+    def allow(self, key: typing.Hashable) -> bool:
+        """Count an attempt of the key
+
+        Args:
+            key (typing.Hashable): Key, e.g. the Telegram id of the user
+
+        Returns:
+            bool: True if the key is within the limit
+        """
+        position = self._clock() / self.window
+        index = int(position)
+        if index > self._cleaned:
+            self._clean(index)
+
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [index, 0, 0]
+        elif counts[0] != index:
+            # The current window became the previous one, or both are over
+            counts[:] = [index, 0, counts[1] if counts[0] == index - 1 else 0]
+
+        counts[1] += 1
+        return counts[2] * (1 - (position - index)) + counts[1] <= self.limit
+
+    def _clean(self, index: int) -> None:
+        """Drop the keys without attempts in the current and previous window"""
+        self._counts = {key: counts for key, counts in self._counts.items() if counts[0] >= index - 1}
+        self._cleaned = index
+
+
+async def allow_shared(
+    r: redis.asyncio.Redis, prefix: str, key: typing.Hashable, limit: int, window: float, now: typing.Optional[float] = None
+) -> bool:
+    """Count an attempt of the key in Redis, the sliding window of SlidingWindow shared by several processes
+
+    A single round-trip: the counter of the current window is incremented and expires after two windows.
+
+    Args:
+        r (redis.asyncio.Redis): Redis client
+        prefix (str): Prefix of the counter keys
+        key (typing.Hashable): Key, e.g. the Telegram id of the user
+        limit (int): Maximum number of attempts per window
+        window (float): Length of the window in seconds
+        now (typing.Optional[float], optional): Time in seconds, the clock has to be the same for all processes.
+            Defaults to time.time().
+
+    Returns:
+        bool: True if the key is within the limit
+    """
+    position = (time.time() if now is None else now) / window
+    index = int(position)
+
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.incr(f"{prefix}:{key}:{index}")
+        pipe.expire(f"{prefix}:{key}:{index}", int(window * 2) + 1)
+        pipe.get(f"{prefix}:{key}:{index - 1}")
+        current, _, previous = await pipe.execute()
+
+    return int(previous or 0) * (1 - (position - index)) + current <= limit
+
+
+class RateLimiter:
+    """Per-user rate limit of the updates, in memory and optionally shared by the replicas through Redis
+
+    The in-memory limit is checked first, it drops most updates of a flooding user without any I/O. The shared limit
+    catches users whose updates are spread over the replicas. Updates are let through when Redis fails.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        redis_client: typing.Optional[redis.asyncio.Redis] = None,
+        prefix: str = "rate_limit",
+    ):
+        """
+        Args:
+            limit (int): Maximum number of updates per user per window
+            window (float): Length of the window in seconds
+            redis_client (typing.Optional[redis.asyncio.Redis], optional): Redis client for the shared limit, only
+                the in-memory limit is used if None. Defaults to None.
+            prefix (str, optional): Prefix of the Redis keys. Defaults to "rate_limit".
+        """
+        self.limit = limit
+        self.window = window
+        self.local = SlidingWindow(limit, window)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        # Updates let through, shed per limiter ("local", "shared") and failed shared checks
+        self.counters: collections.Counter = collections.Counter()
+
+    def allow(self, user_id: int) -> bool:
+        """Check the in-memory limit of the user, without I/O
+
+        Args:
+            user_id (int): Telegram id of the user
+
+        Returns:
+            bool: True if the update of the user can be handled
+        """
+        if self.local.allow(user_id):
+            return True
+        self.counters["local"] += 1
+        return False
+
+    async def allow_shared(self, user_id: int) -> bool:
+        """Check the limit of the user shared by the replicas, True without Redis
+
+        Args:
+            user_id (int): Telegram id of the user
+
+        Returns:
+            bool: True if the update of the user can be handled
+        """
+        if self.redis_client is not None:
+            try:
+                if not await allow_shared(self.redis_client, self.prefix, user_id, self.limit, self.window):
+                    self.counters["shared"] += 1
+                    return False
+            except redis.exceptions.RedisError as e:
+                self.counters["errors"] += 1
+                logger.error(f"Failed to check the rate limit of user {user_id}: {e}")
+
+        self.counters["allowed"] += 1
+        return True
+
+    def metrics(self) -> str:
+        """Counters in the Prometheus text format
+
+        Returns:
+            str: Metrics
+        """
+        return (
+            "# HELP knmi_bot_updates_allowed_total Updates within the rate limit\n"
+            "# TYPE knmi_bot_updates_allowed_total counter\n"
+            f"knmi_bot_updates_allowed_total {self.counters['allowed']}\n"
+            "# HELP knmi_bot_updates_shed_total Updates dropped by the per-user rate limit\n"
+            "# TYPE knmi_bot_updates_shed_total counter\n"
+            f'knmi_bot_updates_shed_total{{limiter="local"}} {self.counters["local"]}\n'
+            f'knmi_bot_updates_shed_total{{limiter="shared"}} {self.counters["shared"]}\n'
+            "# HELP knmi_bot_rate_limit_errors_total Shared rate limit checks that failed, the update was let through\n"
+            "# TYPE knmi_bot_rate_limit_errors_total counter\n"
+            f"knmi_bot_rate_limit_errors_total {self.counters['errors']}\n"
+            "# HELP knmi_bot_rate_limited_keys Users counted by the in-memory rate limit\n"
+            "# TYPE knmi_bot_rate_limited_keys gauge\n"
+            f"knmi_bot_rate_limited_keys {len(self.local)}\n"
+        )
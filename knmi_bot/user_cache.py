@@ -0,0 +1,124 @@
+import asyncio
+import collections
+import typing
+
+from loguru import logger
+
+
+class UserCache:
+    """Write-behind cache of the users, so handling a message doesn't wait for the database
+
+    Keeps the last written properties of the most recently seen users (LRU). Changes are merged per user into a
+    buffer that is written by `flush`, periodically from a background task and on shutdown. Properties that
+    equal the last written, the buffered or the being written ones are not written again.
+
+    Runs in a single event loop, `update` doesn't wait.
+    """
+
+    def __init__(
+        self,
+        write: typing.Callable[[dict], typing.Awaitable[None]],
+        max_size: int = 100_000,
+        flush_interval: float = 1.0,
+        concurrency: int = 4,
+    ):
+        """
+        Args:
+            write (typing.Callable[[dict], typing.Awaitable[None]]): Writes the changed properties of a user,
+                e.g. users.save_user
+            max_size (int, optional): Maximum number of known users. Defaults to 100_000.
+            flush_interval (float, optional): Seconds between flushes of the buffer. Defaults to 1.0.
+            concurrency (int, optional): Users written at the same time by a flush. Defaults to 4.
+        """
+        self._write = write
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self._known: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self._pending: typing.Dict[str, dict] = {}
+        # Changes taken from the buffer by the running flush
+        self._writing: typing.Dict[str, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def update(self, user_props: dict, force: bool = False) -> None:
+        """Buffer a change of the user, unless it equals the properties the user will have once the buffer is written
+
+        Args:
+            user_props (dict): User properties, with the telegram_id
+            force (bool, optional): Write even if nothing changed, e.g. when the user may have been changed
+                elsewhere. Defaults to False.
+        """
+        key = str(user_props["telegram_id"])
+
+        known = self._known.get(key)
+        if known is not None:
+            self._known.move_to_end(key)
+
+        if not force and (known is not None or key in self._writing or key in self._pending):
+            # The last written properties, with the changes that are written after them
+            current = {**(known or {}), **self._writing.get(key, {}), **self._pending.get(key, {})}
+            if all(name in current and current[name] == value for name, value in user_props.items()):
+                return
+
+        self._pending[key] = {**self._pending.get(key, {}), **user_props}
+
+    async def flush(self) -> int:
+        """Write the buffered changes, writes that failed on a connection or server error stay buffered
+
+        Returns:
+            int: Number of users written
+        """
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            self._writing = pending
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def write(key: str, user_props: dict) -> bool:
+                async with semaphore:
+                    try:
+                        await self._write(user_props)
+                    except Exception as e:
+                        logger.error(f"Failed to write user {key}: {e}")
+                        status_code = getattr(e, "status", None)
+                        if status_code is None or status_code >= 500:
+                            # Changes buffered in the meantime are newer
+                            self._pending[key] = {**user_props, **self._pending.get(key, {})}
+                        # Otherwise rejected by the database, writing it again won't help
+                        return False
+
+                self._known[key] = {**self._known.get(key, {}), **user_props}
+                self._known.move_to_end(key)
+                while len(self._known) > self.max_size:
+                    self._known.popitem(last=False)
+                return True
+
+            try:
+                written = await asyncio.gather(*(write(key, user_props) for key, user_props in pending.items()))
+            finally:
+                self._writing = {}
+            return sum(written)
+
+    def start(self) -> None:
+        """Flush the buffer every flush_interval seconds in a background task of the running event loop"""
+        if self._task is not None:
+            return
+
+        async def run():
+            while not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    await self.flush()
+
+        self._stopping.clear()
+        self._task = asyncio.create_task(run(), name="user-cache-flush")
+
+    async def stop(self) -> None:
+        """Stop the background task, after its running flush, and write what is still buffered"""
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -1,31 +1,138 @@
+import asyncio
 import os
+import typing
 
-import requests
+import aiohttp  # ty: ignore[unresolved-import]
+import redis  # ty: ignore[unresolved-import]
+import redis.asyncio  # ty: ignore[unresolved-import]
+from loguru import logger
 
 API_BASE = os.getenv("API_URL")
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "4"))
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))
+# Gateway errors of the database API, the request is retried
+RETRY_STATUSES = (502, 503, 504)
 
+REDIS_HOST = "redis"
+REDIS_CHANNEL = os.getenv("REDIS_CHANNEL")
+# The notifiers keep an index of the subscribers, every changed user is added to this stream to update it
+USER_CHANGES_STREAM = f"{REDIS_CHANNEL}:user_changes"
+USER_CHANGES_MAXLEN = int(os.getenv("USER_CHANGES_MAXLEN", "100000"))
 
-def update_user_region(telegram_id: str, region: str):
-    """Update user region
+
+def create_session(pool_size: int = API_POOL_SIZE) -> aiohttp.ClientSession:
+    """Create the HTTP session for the database API, connections are kept alive and shared by all requests
+
+    Has to be called from the event loop.
 
     Args:
-        telegram_id (str): Telegram id of the user
-        region (str): Region of the user
-    """
-    user_props = {"region": region}
+        pool_size (int, optional): Number of connections kept open. Defaults to API_POOL_SIZE.
 
-    r = requests.patch(
-        f"{API_BASE}/users",
-        params={"telegram_id": f"eq.{telegram_id}"},
+    Returns:
+        aiohttp.ClientSession: HTTP session
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size),
         headers={"Content-Type": "application/json"},
-        json=user_props,
-        timeout=5,
+        timeout=aiohttp.ClientTimeout(total=5),
     )
 
-    r.raise_for_status()
+
+session: typing.Optional[aiohttp.ClientSession] = None
+redis_client = redis.asyncio.Redis(host=REDIS_HOST) if REDIS_CHANNEL else None
+
+
+async def open_session() -> aiohttp.ClientSession:
+    """Open the HTTP session of the database API
+
+    Returns:
+        aiohttp.ClientSession: HTTP session
+    """
+    global session
+    if session is None or session.closed:
+        session = create_session()
+    return session
+
+
+async def close_session():
+    """Close the HTTP session of the database API and the Redis connections"""
+    if session is not None:
+        await session.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+async def request_users(method: str, params: dict, headers: dict, user_props: dict, retries: int = API_RETRIES):
+    """Send a request to the /users endpoint
+
+    All writes are idempotent (upserts and PATCHes that set fields), so they are retried on connection errors and 5xx.
+
+    Args:
+        method (str): HTTP method
+        params (dict): Query parameters
+        headers (dict): Extra headers
+        user_props (dict): JSON body
+        retries (int, optional): Maximum number of retries. Defaults to API_RETRIES.
+
+    Raises:
+        aiohttp.ClientResponseError: The request was rejected
+    """
+    client = await open_session()
+
+    for attempt in range(retries + 1):
+        try:
+            async with client.request(method, f"{API_BASE}/users", params=params, headers=headers, json=user_props) as r:
+                if r.status not in RETRY_STATUSES or attempt == retries:
+                    r.raise_for_status()
+                    return
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+
+        await asyncio.sleep(0.2 * 2**attempt)
+
+
+async def publish_user_change(telegram_id: str):
+    """Tell the notifiers that the user changed
+
+    A failure is only logged, the notifiers reload their index periodically.
+
+    Args:
+        telegram_id (str): Telegram id of the user
+    """
+    if redis_client is None:
+        return
+
+    try:
+        await redis_client.xadd(
+            USER_CHANGES_STREAM, {"telegram_id": telegram_id}, maxlen=USER_CHANGES_MAXLEN, approximate=True
+        )
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Failed to publish the change of user {telegram_id}: {e}")
+
+
+async def update_user(telegram_id: str, user_props: dict):
+    """Update several properties of the user in a single request
+
+    Args:
+        telegram_id (str): Telegram id of the user
+        user_props (dict): Properties to set
+    """
+    await request_users("PATCH", {"telegram_id": f"eq.{telegram_id}"}, {"Prefer": "return=minimal"}, user_props)
+    await publish_user_change(telegram_id)
+
+
+async def update_user_region(telegram_id: str, region: str):
+    """Update user region
+
+    Args:
+        telegram_id (str): Telegram id of the user
+        region (str): Region of the user
+    """
+    await update_user(telegram_id, {"region": region})
 
 
-def update_user_mute_code(telegram_id: str, mute_code: str, value: bool = False):
+async def update_user_mute_code(telegram_id: str, mute_code: str, value: bool = False):
     """Set mute code for the user
 
     Args:
@@ -33,60 +140,51 @@ def update_user_mute_code(telegram_id: str, mute_code: str, value: bool = False)
         mute_code (str): Mute code
         value (bool, optional): Mute value. Defaults to False.
     """
-    user_props = {f"notify_{mute_code.lower()}": value}
+    await update_user(telegram_id, {f"notify_{mute_code.lower()}": value})
 
-    r = requests.patch(
-        f"{API_BASE}/users",
-        params={"telegram_id": f"eq.{telegram_id}"},
-        headers={"Content-Type": "application/json"},
-        json=user_props,
-        timeout=5,
-    )
 
-    r.raise_for_status()
+async def reset_user_mute_codes(telegram_id: str, mute_codes: list):
+    """Enable all mute codes for the user in a single request
+
+    Args:
+        telegram_id (str): Telegram id of the user
+        mute_codes (list): Mute codes
+    """
+    await update_user(telegram_id, {f"notify_{mute_code.lower()}": True for mute_code in mute_codes})
 
 
-def soft_delete_user(telegram_id: str):
+async def soft_delete_user(telegram_id: str):
     """Soft delete user
 
     Args:
         telegram_id (str): Telegram id of the user
     """
-    user_props = {"is_deleted": True}
+    await update_user(telegram_id, {"is_deleted": True})
 
-    r = requests.patch(
-        f"{API_BASE}/users",
-        params={"telegram_id": f"eq.{telegram_id}"},
-        headers={"Content-Type": "application/json"},
-        json=user_props,
-        timeout=5,
-    )
 
-    r.raise_for_status()
+async def create_or_update_user(user_props: dict):
+    """Create or update user in a single request
 
-
-def create_or_update_user(user_props: dict):
-    """Create or update user
+    Only the given properties are set on an existing user, new users get the defaults for the others.
 
     Args:
-        user_props (dict): User properties
+        user_props (dict): User properties, with the telegram_id
     """
-    r = requests.post(
-        f"{API_BASE}/users",
-        headers={"Content-Type": "application/json"},
-        json=user_props,
-        timeout=5,
+    await request_users(
+        "POST", {"on_conflict": "telegram_id"}, {"Prefer": "resolution=merge-duplicates,return=minimal"}, user_props
     )
+    await publish_user_change(user_props["telegram_id"])
 
-    if r.status_code == 409:
-        r = requests.patch(
-            f"{API_BASE}/users",
-            params={"telegram_id": f"eq.{user_props['telegram_id']}"},
-            headers={"Content-Type": "application/json"},
-            json=user_props,
-            timeout=5,
-        )
 
-        r.raise_for_status()
+async def save_user(user_props: dict):
+    """Write the changed properties of the user in a single request
+
+    Inserting a user needs the username, so changes without it are a PATCH of the existing user.
+
+    Args:
+        user_props (dict): User properties, with the telegram_id
+    """
+    if "username" in user_props:
+        await create_or_update_user(user_props)
     else:
-        r.raise_for_status()
+        await update_user(user_props["telegram_id"], {k: v for k, v in user_props.items() if k != "telegram_id"})
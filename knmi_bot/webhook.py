@@ -0,0 +1,154 @@
+import asyncio
+import hmac
+import json
+import socket
+import typing
+
+import telebot  # ty: ignore[unresolved-import]
+from aiohttp import web  # ty: ignore[unresolved-import]
+from chat_scheduler import ChatScheduler
+from loguru import logger
+from telebot.async_telebot import AsyncTeleBot  # ty: ignore[unresolved-import]
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+BOT_KEY = web.AppKey("bot", AsyncTeleBot)
+SCHEDULER_KEY = web.AppKey("scheduler", ChatScheduler)
+STATE_KEY = web.AppKey("state", dict)
+
+
+def create_app(
+    bot: AsyncTeleBot,
+    scheduler: ChatScheduler,
+    secret_token: typing.Optional[str],
+    path: str = "/telegram",
+    max_queued: int = 10_000,
+    metrics: typing.Optional[typing.Callable[[], str]] = None,
+) -> web.Application:
+    """Create the webhook server: Telegram posts the updates to `path`, they are handled by the bot's handlers
+
+    An update is acknowledged once it is queued in the scheduler, so Telegram doesn't wait for the handler. Updates
+    are refused with 503 when `max_queued` updates are waiting, Telegram sends them again later.
+
+    Routes:
+        POST {path}: Update from Telegram, 403 without the secret token; not served without a secret token
+        GET /healthz: Liveness, 200 while the event loop runs
+        GET /readyz: Readiness, 503 before the server is started, on shutdown and when the queue is full
+        GET /metrics: Counters of the server and the given metrics in the Prometheus text format
+
+    Args:
+        bot (AsyncTeleBot): Telegram bot with the handlers
+        scheduler (ChatScheduler): Scheduler running the handlers of the bot
+        secret_token (typing.Optional[str]): Secret token set with the webhook, None to only serve the probes and
+            the metrics, e.g. when polling
+        path (str, optional): Path of the webhook. Defaults to "/telegram".
+        max_queued (int, optional): Maximum number of queued updates. Defaults to 10_000.
+        metrics (typing.Optional[typing.Callable[[], str]], optional): More metrics in the Prometheus text format.
+            Defaults to None.
+
+    Returns:
+        web.Application: Webhook server
+    """
+    app = web.Application()
+    app[BOT_KEY] = bot
+    app[SCHEDULER_KEY] = scheduler
+    app[STATE_KEY] = {"ready": False, "updates": 0, "refused": 0, "unauthorized": 0}
+    # Keeps a reference to the running updates, the event loop doesn't
+    tasks: typing.Set[asyncio.Task] = set()
+    # Compared as bytes, so a header with non-ASCII characters is refused like any wrong token. The route is not
+    # served without a secret token
+    expected_token = secret_token.encode() if secret_token else b""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        state = request.app[STATE_KEY]
+        token = request.headers.get(SECRET_TOKEN_HEADER, "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(token, expected_token):
+            state["unauthorized"] += 1
+            return web.Response(status=403)
+
+        if not state["ready"] or len(scheduler) >= max_queued:
+            state["refused"] += 1
+            return web.Response(status=503)
+
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+        except (ValueError, KeyError) as e:
+            logger.error(f"Invalid update: {e}")
+            return web.Response(status=400)
+
+        state["updates"] += 1
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def ready(request: web.Request) -> web.Response:
+        state = request.app[STATE_KEY]
+        body = json.dumps({**state, "queued": len(scheduler)})
+        if not state["ready"] or len(scheduler) >= max_queued:
+            return web.Response(status=503, text=body, content_type="application/json")
+        return web.Response(text=body, content_type="application/json")
+
+    async def get_metrics(request: web.Request) -> web.Response:
+        state = request.app[STATE_KEY]
+        body = (
+            "# HELP knmi_bot_webhook_updates_total Updates received by the webhook, per result\n"
+            "# TYPE knmi_bot_webhook_updates_total counter\n"
+            f'knmi_bot_webhook_updates_total{{result="queued"}} {state["updates"]}\n'
+            f'knmi_bot_webhook_updates_total{{result="refused"}} {state["refused"]}\n'
+            f'knmi_bot_webhook_updates_total{{result="unauthorized"}} {state["unauthorized"]}\n'
+            "# HELP knmi_bot_queued_updates Updates queued or being handled\n"
+            "# TYPE knmi_bot_queued_updates gauge\n"
+            f"knmi_bot_queued_updates {len(scheduler)}\n"
+        )
+        if metrics is not None:
+            body += metrics()
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+    if expected_token:
+        app.router.add_post(path, handle_update)
+    app.router.add_get("/healthz", health)
+    app.router.add_get("/readyz", ready)
+    app.router.add_get("/metrics", get_metrics)
+
+    return app
+
+
+async def start(
+    app: web.Application, host: str = "0.0.0.0", port: int = 8080, sock: typing.Optional[socket.socket] = None
+) -> web.AppRunner:
+    """Start the webhook server and mark it ready
+
+    Args:
+        app (web.Application): Webhook server, see create_app
+        host (str, optional): Host to listen on. Defaults to "0.0.0.0".
+        port (int, optional): Port to listen on. Defaults to 8080.
+        sock (typing.Optional[socket.socket], optional): Listen on this socket instead. Defaults to None.
+
+    Returns:
+        web.AppRunner: Runner of the server, to stop it
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.SockSite(runner, sock) if sock is not None else web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"HTTP server listening on {site.name}")
+
+    app[STATE_KEY]["ready"] = True
+    return runner
+
+
+async def stop(app: web.Application, runner: web.AppRunner) -> None:
+    """Stop the webhook server, the queued updates are still handled
+
+    Args:
+        app (web.Application): Webhook server, see create_app
+        runner (web.AppRunner): Runner of the server, see start
+    """
+    # Not ready anymore, so the load balancer stops sending updates before the server stops
+    app[STATE_KEY]["ready"] = False
+    await runner.cleanup()
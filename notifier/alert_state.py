@@ -0,0 +1,101 @@
+import hashlib
+import json
+import typing
+
+import redis  # ty: ignore[unresolved-import]
+
+SEVERITY = {"yellow": 1, "orange": 2, "red": 3}
+ALERT_STATUSES = ("new", "escalated", "updated", "unchanged", "ended")
+
+
+def state_field(location: str, phenomenon: str) -> str:
+    """Field of an alert in the state hash, alerts are keyed by (region, phenomenon)
+
+    Args:
+        location (str): Location of the alert
+        phenomenon (str): Phenomenon of the alert
+
+    Returns:
+        str: Field name
+    """
+    return f"{location}:{phenomenon}"
+
+
+def fingerprint(alert: dict) -> str:
+    """Fingerprint of the alert content: the code and a hash of the start/end time and the texts
+
+    Args:
+        alert (dict): Alert information
+
+    Returns:
+        str: Fingerprint, e.g. "yellow:3f2a..."
+    """
+    content = json.dumps([alert["start_time"], alert["end_time"], alert["text"]], sort_keys=True)
+    return f"{alert['code'].lower()}:{hashlib.sha256(content.encode()).hexdigest()[:16]}"
+
+
+def classify(alert: dict, previous: typing.Optional[str]) -> str:
+    """Get the status of the alert compared to its last known fingerprint
+
+    The status the checker annotated is used for what the notifier can't know by itself: "ended" alerts, and
+    alerts the checker has published before when no state is known yet (e.g. the state was lost), which are not
+    sent again.
+
+    Args:
+        alert (dict): Alert information, annotated with the status of the checker
+        previous (typing.Optional[str]): Last known fingerprint, None if unknown
+
+    Returns:
+        str: "new", "escalated" (higher code), "updated", "unchanged" or "ended"
+    """
+    if alert.get("status") == "ended":
+        return "ended"
+
+    if previous is None:
+        return "unchanged" if alert.get("status") == "unchanged" else "new"
+
+    current = fingerprint(alert)
+    if current == previous:
+        return "unchanged"
+
+    previous_code = previous.split(":", 1)[0]
+    if SEVERITY.get(alert["code"].lower(), 0) > SEVERITY.get(previous_code, 0):
+        return "escalated"
+
+    return "updated"
+
+
+def get_alert_states(r: redis.Redis, key: str, fields: typing.List[str]) -> typing.Dict[str, typing.Optional[str]]:
+    """Get the last known fingerprints of the alerts in a single round-trip
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the state hash
+        fields (typing.List[str]): Fields of the alerts, see state_field
+
+    Returns:
+        typing.Dict[str, typing.Optional[str]]: Fingerprint per field, None if unknown
+    """
+    if not fields:
+        return {}
+    values = r.hmget(key, fields)
+    return {field: value.decode() if isinstance(value, bytes) else value for field, value in zip(fields, values)}
+
+
+def save_alert_states(r: redis.Redis, key: str, states: typing.Dict[str, typing.Optional[str]]) -> None:
+    """Store the fingerprints of the changed alerts, ended alerts (None) are removed
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the state hash
+        states (typing.Dict[str, typing.Optional[str]]): Fingerprint per field
+    """
+    current = {field: value for field, value in states.items() if value is not None}
+    ended = [field for field, value in states.items() if value is None]
+
+    with r.pipeline() as pipe:
+        if current:
+            pipe.hset(key, mapping=current)
+        if ended:
+            pipe.hdel(key, *ended)
+        pipe.execute()
@@ -1,4 +1,6 @@
 import datetime
+import hashlib
+import json
 import os
 
 import requests
@@ -84,3 +86,52 @@ def update_report_for_the_region(region: str, issue_date: str, alerts: list) ->
 
     r.raise_for_status()
     return True
+
+
+def hash_region_report(alerts: list, issue_date: str) -> str:
+    """Hash the content of the report of a region, to skip writing reports that didn't change
+
+    Args:
+        alerts (list): Alerts of the region
+        issue_date (str): Date of the report in iso format
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    return hashlib.sha256(json.dumps([to_psql_date(issue_date), alerts], sort_keys=True).encode()).hexdigest()
+
+
+def upsert_reports_for_the_regions(reports: dict, issue_date: str | None = None) -> None:
+    """Create or update the reports of several regions in a single request
+
+    Args:
+        reports (dict): Alerts per region
+        issue_date (str | None, optional): Date of the reports in iso format. Defaults to today.
+    """
+    if not reports:
+        return
+
+    now = datetime.datetime.now().isoformat()
+    if issue_date is None:
+        issue_date = now
+
+    # created_at is left out, so it keeps the value of the first insert of the day
+    body = [
+        {
+            "region": region,
+            "issue_date": to_psql_date(issue_date),
+            "alerts": alerts,
+            "updated_at": to_psql_datetime(now),
+        }
+        for region, alerts in reports.items()
+    ]
+
+    r = requests.post(
+        f"{API_BASE}/alerts",
+        json=body,
+        headers={"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"},
+        timeout=5,
+    )
+
+    r.raise_for_status()
+    logger.info(f"Stored the reports of {len(reports)} regions")
@@ -0,0 +1,119 @@
+import argparse
+import importlib
+import random
+import statistics
+import sys
+import time
+import timeit
+import tracemalloc
+import typing
+
+from subscribers import CODES, REGIONS, SubscriberIndex
+
+
+def make_users(count: int, seed: int = 42) -> typing.Iterator[dict]:
+    """Make a synthetic user population, spread evenly over the regions with random mute settings
+
+    Args:
+        count (int): Number of users
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Yields:
+        dict: User as returned by the /users endpoint
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield {
+            "telegram_id": str(rnd.randrange(10**9, 10**10)),
+            "region": REGIONS[i % len(REGIONS)],
+            "is_deleted": False,
+            **{f"notify_{code}": rnd.random() < 0.9 for code in CODES},
+        }
+
+
+def bench_index(user_count: int, rounds: int) -> None:
+    """Measure the memory, load time and lookup time of the subscriber index
+
+    Args:
+        user_count (int): Number of users in the index
+        rounds (int): Number of rounds of the lookup benchmark
+    """
+    index = SubscriberIndex()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index.load(make_users(user_count))
+    load_time = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = timeit.repeat(lambda: index.recipients("Utrecht", ["yellow", "orange"]), number=1, repeat=rounds)
+    recipients = sum(len(chat_ids) for chat_ids in index.recipients("Utrecht", ["yellow", "orange"]).values())
+
+    start = time.perf_counter()
+    for user in make_users(1000, seed=7):
+        index.update(user)
+    update_time = (time.perf_counter() - start) / 1000
+
+    print(f"{len(index)} subscribers loaded in {load_time:.2f} s")
+    print(
+        f"  memory  {size / 1024 / 1024:.1f} MiB ({size / len(index):.1f} bytes per user), load peak {peak / 1024 / 1024:.1f} MiB"
+    )
+    print(f"  memory  {size / len(index) * 1_000_000 / 1024 / 1024:.1f} MiB per million users")
+    print(f"  lookup  median {statistics.median(timings) * 1000:.1f} ms for {recipients} recipients in one region")
+    print(f"  update  {update_time * 1_000_000:.1f} us per user")
+
+
+def bench_render(rounds: int) -> None:
+    """Measure rendering the alert message and the reply markup, cold and from the render cache
+
+    Args:
+        rounds (int): Number of rounds, every round renders 1000 times
+    """
+    # Taken from sys.modules, as the type checker resolves `notifier` to this directory instead of notifier.py
+    importlib.import_module("notifier")
+    notifier = sys.modules["notifier"]
+    make_alert_message, make_reply_markup = notifier.make_alert_message, notifier.make_reply_markup
+    render_alerts_message, pretty_date = notifier.render_alerts_message, notifier.pretty_date
+
+    alert = {
+        "phenomenon_name": "wind",
+        "code": "YELLOW",
+        "start_time": "2024-01-01T10:00:00+00:00",
+        "end_time": "2024-01-02T12:00:00+00:00",
+        "text": {"EN": "Heavy gusts", "NL": "Zware windstoten"},
+    }
+
+    def render():
+        make_alert_message(alert)
+        make_reply_markup("Utrecht")
+
+    def render_cold():
+        render_alerts_message.cache_clear()
+        pretty_date.cache_clear()
+        make_reply_markup.cache_clear()
+        render()
+
+    for name, func in (("cold", render_cold), ("cached", render)):
+        timings = [t / 1000 for t in timeit.repeat(func, number=1000, repeat=rounds)]
+        print(f"render {name:<7} median {statistics.median(timings) * 1_000_000:.1f} us per message")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the notifier")
+    parser.add_argument("command", choices=["index", "render"], help="Benchmark to run")
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000_000], help="Population sizes")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of rounds")
+    args = parser.parse_args()
+
+    match args.command:
+        case "index":
+            for user_count in args.users:
+                bench_index(user_count, args.rounds)
+                sys.stdout.flush()
+        case "render":
+            bench_render(args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import concurrent.futures
+import threading
+import time
+import typing
+
+import telebot  # ty: ignore[unresolved-import]
+from loguru import logger
+
+
+class TokenBucket:
+    """Thread-safe token bucket, `acquire` blocks until a token is available
+
+    Tokens are reserved under the lock and waited for outside of it, so concurrent senders are served in order.
+    A rate of 0 or less disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(self._paused_until - now, -self._tokens / self.rate if self._tokens < 0 else 0)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds`, e.g. after Telegram answered with retry_after"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Telegram rate limits: a global limit over all chats and a limit per chat"""
+
+    def __init__(self, global_rate: float, chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_interval = 1 / chat_rate if chat_rate > 0 else 0
+        self._chat_next: typing.Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id: str) -> None:
+        if self.chat_interval:
+            with self._lock:
+                now = time.monotonic()
+                if len(self._chat_next) > 100_000:
+                    self._chat_next = {chat: at for chat, at in self._chat_next.items() if at > now}
+                send_at = max(now, self._chat_next.get(chat_id, now))
+                self._chat_next[chat_id] = send_at + self.chat_interval
+
+            if send_at > now:
+                time.sleep(send_at - now)
+
+        self.global_bucket.acquire()
+
+    def pause(self, seconds: float) -> None:
+        self.global_bucket.pause(seconds)
+
+
+def get_retry_after(e: Exception) -> typing.Optional[int]:
+    """Get the retry_after of a Telegram 429 response
+
+    Args:
+        e (Exception): Exception raised by the bot client
+
+    Returns:
+        typing.Optional[int]: Seconds to wait, None if the exception is not a 429
+    """
+    if isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code == 429:
+        return (e.result_json.get("parameters") or {}).get("retry_after", 1)
+    return None
+
+
+def is_unreachable(e: Exception) -> bool:
+    """Check if the error means the chat can't be reached anymore: the user blocked the bot or the chat is gone
+
+    Rate limits (429), server errors and other bad requests are transient or caused by the message,
+    the user must not be deleted for them.
+
+    Args:
+        e (Exception): Exception raised by the bot client
+
+    Returns:
+        bool: True if the error is permanent for the chat, False otherwise
+    """
+    if not isinstance(e, telebot.apihelper.ApiTelegramException):
+        return False
+    if e.error_code == 403:
+        return True
+    return e.error_code == 400 and "chat not found" in (e.description or "").lower()
+
+
+DELIVERED = "delivered"
+UNREACHABLE = "unreachable"
+FAILED = "failed"
+
+
+def fan_out(
+    send: typing.Callable[[typing.Any], bool],
+    items: typing.Iterable[typing.Any],
+    limiter: RateLimiter,
+    workers: int,
+    chat_id: typing.Callable[[typing.Any], str] = str,
+    max_retries: int = 5,
+) -> typing.List[str]:
+    """Send a message for every item concurrently, respecting the rate limits
+
+    A 429 response pauses all senders for its retry_after and the message is retried, so rate limiting
+    doesn't drop messages.
+
+    Args:
+        send (typing.Callable[[typing.Any], bool]): Sends the message for an item, returns False if the chat is
+            unreachable
+        items (typing.Iterable[typing.Any]): Items to send a message for, e.g. chat ids or delivery jobs
+        limiter (RateLimiter): Rate limiter shared by all deliveries
+        workers (int): Number of concurrent senders
+        chat_id (typing.Callable[[typing.Any], str], optional): Gets the chat id of an item. Defaults to str.
+        max_retries (int, optional): Maximum number of retries after a 429. Defaults to 5.
+
+    Returns:
+        typing.List[str]: Status per item: DELIVERED, UNREACHABLE (the chat blocked the bot or is gone) or
+            FAILED (transient error, the message can be retried later)
+    """
+
+    def deliver(item: typing.Any) -> str:
+        for attempt in range(max_retries + 1):
+            limiter.acquire(chat_id(item))
+            try:
+                return DELIVERED if send(item) else UNREACHABLE
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None:
+                    logger.error(f"Failed to send message to {chat_id(item)}: {e}")
+                    return FAILED
+                logger.warning(f"Rate limited by Telegram, retrying {chat_id(item)} in {retry_after}s ({attempt + 1})")
+                limiter.pause(retry_after)
+
+        logger.error(f"Failed to send message to {chat_id(item)}: still rate limited after {max_retries} retries")
+        return FAILED
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(deliver, items))
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import typing
+
+import redis  # ty: ignore[unresolved-import]
+
+# A job is a Redis Stream entry: (entry id, fields), a delivery or a record of the changes stream
+Job = typing.Tuple[str, typing.Dict[str, str]]
+
+
+def create_group(r: redis.Redis, stream: str, group: str) -> None:
+    """Create the consumer group of the delivery stream, the stream is created if it doesn't exist
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the delivery stream
+        group (str): Name of the consumer group
+    """
+    try:
+        r.xgroup_create(stream, group, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def make_idempotency_key(sequence: int, location: str, phenomenon: str, chat_id: str) -> str:
+    """Make the key identifying a single delivery, the same alert of the same record is never sent twice to a chat
+
+    Args:
+        sequence (int): Sequence number of the record
+        location (str): Location of the alert
+        phenomenon (str): Phenomenon of the alert
+        chat_id (str): Chat id of the user
+
+    Returns:
+        str: Idempotency key
+    """
+    return f"{sequence}:{location}:{phenomenon}:{chat_id}"
+
+
+def store_message(r: redis.Redis, prefix: str, message: str, ttl: int) -> str:
+    """Store a rendered message once, the jobs of all its recipients refer to it by id
+
+    Args:
+        r (redis.Redis): Redis client
+        prefix (str): Key prefix of the messages
+        message (str): Rendered message
+        ttl (int): Seconds the message is kept, must cover the retries of its jobs
+
+    Returns:
+        str: Message id
+    """
+    message_id = hashlib.sha256(message.encode()).hexdigest()[:32]
+    r.set(f"{prefix}:{message_id}", message, ex=ttl)
+    return message_id
+
+
+def get_messages(r: redis.Redis, prefix: str, message_ids: typing.Iterable[str]) -> typing.Dict[str, str]:
+    """Get stored messages by id, expired messages are left out
+
+    Args:
+        r (redis.Redis): Redis client
+        prefix (str): Key prefix of the messages
+        message_ids (typing.Iterable[str]): Message ids
+
+    Returns:
+        typing.Dict[str, str]: Message per id
+    """
+    message_ids = list(set(message_ids))
+    if not message_ids:
+        return {}
+    values = r.mget([f"{prefix}:{message_id}" for message_id in message_ids])
+    return {message_id: value for message_id, value in zip(message_ids, values) if value is not None}
+
+
+def enqueue_jobs(r: redis.Redis, stream: str, jobs: typing.Iterable[dict], batch_size: int = 1000) -> int:
+    """Add delivery jobs to the stream, pipelined in batches
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the delivery stream
+        jobs (typing.Iterable[dict]): Job fields, string values only
+        batch_size (int, optional): Number of jobs per round-trip. Defaults to 1000.
+
+    Returns:
+        int: Number of jobs added
+    """
+    count = 0
+    with r.pipeline(transaction=False) as pipe:
+        for job in jobs:
+            pipe.xadd(stream, job)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+    return count
+
+
+def get_last_id(r: redis.Redis, stream: str) -> str:
+    """Get the id of the last entry of a stream, to read only the entries added after it
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the stream
+
+    Returns:
+        str: Id of the last entry, "0-0" if the stream is empty
+    """
+    entries = r.xrevrange(stream, count=1)
+    return entries[0][0] if entries else "0-0"
+
+
+def read_jobs(
+    r: redis.Redis, stream: str, group: str, consumer: str, count: int, block_ms: typing.Optional[int], start_id: str = ">"
+) -> typing.List[Job]:
+    """Read new jobs for this consumer, they stay pending in the group until acked
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the stream
+        group (str): Name of the consumer group
+        consumer (str): Name of this consumer
+        count (int): Maximum number of jobs
+        block_ms (typing.Optional[int]): Milliseconds to wait for jobs, None to return immediately
+        start_id (str, optional): ">" for new jobs, "0" for the jobs this consumer read but didn't ack,
+            e.g. before a restart. Defaults to ">".
+
+    Returns:
+        typing.List[Job]: Jobs, empty if none arrived in time
+    """
+    response = r.xreadgroup(group, consumer, {stream: start_id}, count=count, block=block_ms)
+    return [job for _, jobs in response or [] for job in jobs]
+
+
+def claim_stale_jobs(
+    r: redis.Redis, stream: str, group: str, consumer: str, min_idle_ms: int, count: int
+) -> typing.List[typing.Tuple[Job, int]]:
+    """Take over jobs that stayed pending for `min_idle_ms`: failed deliveries or jobs of a crashed consumer
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the delivery stream
+        group (str): Name of the consumer group
+        consumer (str): Name of this consumer
+        min_idle_ms (int): Milliseconds a job has to be pending before it is retried
+        count (int): Maximum number of jobs
+
+    Returns:
+        typing.List[typing.Tuple[Job, int]]: Claimed jobs with the number of times they were delivered to a consumer
+    """
+    _, jobs, *_ = r.xautoclaim(stream, group, consumer, min_idle_ms, start_id="0-0", count=count)
+    jobs = [(job_id, fields) for job_id, fields in jobs if fields]
+    if not jobs:
+        return []
+
+    # XAUTOCLAIM doesn't return the delivery counts. They are looked up per claimed job, a range over the claimed ids
+    # can hold other pending jobs of this consumer
+    with r.pipeline() as pipe:
+        for job_id, _ in jobs:
+            pipe.xpending_range(stream, group, min=job_id, max=job_id, count=1, consumername=consumer)
+        pending = pipe.execute()
+
+    return [(job, entries[0]["times_delivered"] if entries else 1) for job, entries in zip(jobs, pending)]
+
+
+def ack_jobs(r: redis.Redis, stream: str, group: str, job_ids: typing.List[str]) -> None:
+    """Acknowledge finished jobs and remove them from the stream
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the delivery stream
+        group (str): Name of the consumer group
+        job_ids (typing.List[str]): Ids of the finished jobs
+    """
+    if not job_ids:
+        return
+    with r.pipeline() as pipe:
+        pipe.xack(stream, group, *job_ids)
+        pipe.xdel(stream, *job_ids)
+        pipe.execute()
+
+
+def dead_letter_jobs(r: redis.Redis, stream: str, group: str, key: str, jobs: typing.List[Job], reason: str) -> None:
+    """Move jobs that can't be delivered to the dead-letter list
+
+    Args:
+        r (redis.Redis): Redis client
+        stream (str): Key of the delivery stream
+        group (str): Name of the consumer group
+        key (str): Key of the dead-letter list
+        jobs (typing.List[Job]): Jobs to move
+        reason (str): Why the jobs are given up
+    """
+    if not jobs:
+        return
+    with r.pipeline() as pipe:
+        pipe.rpush(key, *(json.dumps({"id": job_id, "reason": reason, **fields}) for job_id, fields in jobs))
+        pipe.xack(stream, group, *(job_id for job_id, _ in jobs))
+        pipe.xdel(stream, *(job_id for job_id, _ in jobs))
+        pipe.execute()
+
+
+def get_delivered(r: redis.Redis, prefix: str, keys: typing.List[str]) -> typing.Set[str]:
+    """Get the idempotency keys of the jobs that were already delivered
+
+    Args:
+        r (redis.Redis): Redis client
+        prefix (str): Key prefix of the delivery markers
+        keys (typing.List[str]): Idempotency keys
+
+    Returns:
+        typing.Set[str]: Keys that were delivered
+    """
+    if not keys:
+        return set()
+    values = r.mget([f"{prefix}:{key}" for key in keys])
+    return {key for key, value in zip(keys, values) if value is not None}
+
+
+def mark_delivered(r: redis.Redis, prefix: str, keys: typing.List[str], ttl: int) -> None:
+    """Remember that the jobs were delivered, so a retried or reclaimed job isn't sent again
+
+    Args:
+        r (redis.Redis): Redis client
+        prefix (str): Key prefix of the delivery markers
+        keys (typing.List[str]): Idempotency keys
+        ttl (int): Seconds the markers are kept
+    """
+    if not keys:
+        return
+    with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.set(f"{prefix}:{key}", 1, ex=ttl)
+        pipe.execute()
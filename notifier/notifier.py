@@ -1,20 +1,95 @@
+import collections
 import datetime
+import functools
 import json
 import os
+import socket
+import threading
 import time
 import typing
 
 import redis  # ty: ignore[unresolved-import]
 import requests
 import telebot  # ty: ignore[unresolved-import]
-from alerts import create_report_for_the_region
+from alert_state import classify, fingerprint, get_alert_states, save_alert_states, state_field
+from alerts import hash_region_report, upsert_reports_for_the_regions
+from delivery import DELIVERED, FAILED, UNREACHABLE, RateLimiter, fan_out, is_unreachable
+from delivery_queue import (
+    Job,
+    ack_jobs,
+    claim_stale_jobs,
+    create_group,
+    dead_letter_jobs,
+    enqueue_jobs,
+    get_delivered,
+    get_last_id,
+    get_messages,
+    make_idempotency_key,
+    mark_delivered,
+    read_jobs,
+    store_message,
+)
 from get_docker_secret import get_docker_secret
 from loguru import logger
+from subscribers import SubscriberIndex
 
 REDIS_HOST = "redis"
 REDIS_CHANNEL = os.getenv("REDIS_CHANNEL")
 API_BASE = os.getenv("API_URL")
 
+# Telegram allows about 30 messages per second in total and 1 message per second per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+
+# The checker publishes the changed alerts on this stream, the notifier replicas share it through a consumer group
+CHANGES_STREAM = f"{REDIS_CHANNEL}:changes"
+CHANGES_BLOCK_MS = int(os.getenv("CHANGES_BLOCK_MS", "30000"))
+CHANGES_BATCH_SIZE = int(os.getenv("CHANGES_BATCH_SIZE", "10"))
+CHANGES_DEAD_LETTER = f"{REDIS_CHANNEL}:changes:dead"
+
+# Durable delivery queue: every alert x recipient is a job on a Redis Stream, drained by all notifier replicas
+DELIVERY_STREAM = f"{REDIS_CHANNEL}:deliveries"
+DELIVERY_GROUP = os.getenv("DELIVERY_GROUP", "notifier")
+DELIVERY_CONSUMER = os.getenv("DELIVERY_CONSUMER", socket.gethostname())
+DELIVERY_DEAD_LETTER = f"{REDIS_CHANNEL}:deliveries:dead"
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", "100"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+DELIVERY_RETRY_AFTER_MS = int(os.getenv("DELIVERY_RETRY_AFTER_MS", "60000"))
+# How long rendered messages and idempotency keys are kept, must cover all retries
+DELIVERY_TTL = int(os.getenv("DELIVERY_TTL", str(2 * 24 * 60 * 60)))
+
+# The knmi_bot adds the telegram id of every changed user to this stream, the subscriber index is updated from it
+USER_CHANGES_STREAM = f"{REDIS_CHANNEL}:user_changes"
+USER_CHANGES_BLOCK_MS = int(os.getenv("USER_CHANGES_BLOCK_MS", "30000"))
+SUBSCRIBERS_PAGE_SIZE = int(os.getenv("SUBSCRIBERS_PAGE_SIZE", "50000"))
+# The index is reloaded completely now and then, in case a change was missed
+SUBSCRIBERS_RELOAD_SECONDS = int(os.getenv("SUBSCRIBERS_RELOAD_SECONDS", str(6 * 60 * 60)))
+USER_COLUMNS = "telegram_id,region,is_deleted,notify_red,notify_orange,notify_yellow"
+
+# Fingerprint of the current alert per (region, phenomenon), only new and escalated alerts are sent
+ALERT_STATE_KEY = f"{REDIS_CHANNEL}:alert_state"
+
+# Hash of the last queued report per region, reports are only written when their content changed
+REPORT_STATE_KEY = f"{REDIS_CHANNEL}:report_state"
+# Reports per region waiting to be stored, they are retried until PostgREST accepts them
+PENDING_REPORTS_KEY = f"{REDIS_CHANNEL}:pending_reports"
+
+# Sequence of the last record applied per region, older records replayed after newer ones are skipped for the region
+APPLIED_SEQUENCE_KEY = f"{REDIS_CHANNEL}:applied_sequence"
+# Seconds before a failed record of the changes stream is retried, it blocks the records after it until then
+CHANGES_RETRY_SECONDS = float(os.getenv("CHANGES_RETRY_SECONDS", "5"))
+
+# Unreachable users are soft deleted in bulk, at the latest after this many users or seconds
+SOFT_DELETE_BATCH_SIZE = int(os.getenv("SOFT_DELETE_BATCH_SIZE", "500"))
+SOFT_DELETE_INTERVAL = float(os.getenv("SOFT_DELETE_INTERVAL", "30"))
+
+limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+subscribers = SubscriberIndex()
+pending_deletes: typing.Set[str] = set()
+pending_deletes_lock = threading.Lock()
+last_deletes_flush = time.monotonic()
+
 
 def create_bot_client() -> telebot.TeleBot:
     """Create a telegram bot client
@@ -37,31 +112,69 @@ def create_redis_client() -> redis.Redis:
     return r
 
 
-def make_alert_message(alert: dict) -> str:
+def make_alert_message(alert: dict, language: str = "EN") -> str:
     """Make alert message
 
     Args:
-        location (str): Location of the alert
         alert (dict): Alert information
+        language (str, optional): Language of the description. Defaults to "EN".
 
     Returns:
         str: Alert message
     """
-    code_to_emoji = {"red": "🔴", "orange": "🟠", "yellow": "🟡"}
+    return make_alerts_message([alert], language)
 
-    code_color = alert["code"].lower()
-    emoji_for_code = code_to_emoji.get(code_color, "⚪")
 
-    message = f"""
-🌦️ *Weather Alert* 🌦️
+def make_alerts_message(alerts: typing.List[dict], language: str = "EN") -> str:
+    """Make a single message for all alerts a user gets from a report
+
+    Messages are rendered once per content and language, see render_alerts_message.
+
+    Args:
+        alerts (typing.List[dict]): Alerts, of the same location
+        language (str, optional): Language of the descriptions. Defaults to "EN".
+
+    Returns:
+        str: Alert message
+    """
+    return render_alerts_message(json.dumps(alerts, sort_keys=True), language)
+
+
+@functools.lru_cache(maxsize=1024)
+def render_alerts_message(content: str, language: str) -> str:
+    """Render the message of the alerts, cached by the serialized alerts and the language
+
+    Args:
+        content (str): Alerts serialized with sorted keys
+        language (str): Language of the descriptions, falls back to English
+
+    Returns:
+        str: Alert message
+    """
+    code_to_emoji = {"red": "🔴", "orange": "🟠", "yellow": "🟡"}
 
+    sections = []
+    for alert in json.loads(content):
+        code_color = alert["code"].lower()
+        emoji_for_code = code_to_emoji.get(code_color, "⚪")
+
+        sections.append(
+            f"""
 {emoji_for_code} *Phenomenon*: {alert["phenomenon_name"]}
 🔢 *Code* {emoji_for_code} {alert["code"].lower()}
 ⏰ *Start Time*: {pretty_date(alert["start_time"])}
 ⏳ *End Time*: {pretty_date(alert["end_time"])}
 
 📢 *Description*:
-{alert["text"]["EN"]}
+{alert["text"].get(language) or alert["text"]["EN"]}
+""".strip()
+        )
+
+    body = "\n\n".join(sections)
+    message = f"""
+🌦️ *Weather Alert* 🌦️
+
+{body}
 
 *Please click the button below to read more* 👇
     """.strip()
@@ -69,6 +182,7 @@ def make_alert_message(alert: dict) -> str:
     return message
 
 
+@functools.lru_cache(maxsize=4096)
 def pretty_date(date: str) -> str:
     """Convert date to pretty format
 
@@ -89,6 +203,26 @@ def pretty_date(date: str) -> str:
     return f"{day}{suffix} of {dt.strftime('%B')}, {dt.strftime('%H:%M')}"
 
 
+@functools.lru_cache(maxsize=64)
+def make_reply_markup(location: str) -> str:
+    """Make the inline keyboard of the alert messages of a location, serialized once per location
+
+    Args:
+        location (str): Location of the alert
+
+    Returns:
+        str: reply_markup JSON
+    """
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.row_width = 1
+    markup.add(
+        telebot.types.InlineKeyboardButton(
+            "Visit knmi.nl", url=f"https://www.knmi.nl/nederland-nu/weer/waarschuwingen/{location.lower()}"
+        )
+    )
+    return markup.to_json()
+
+
 def send_alert(bot: telebot.TeleBot, chat_id: str, message: str, location: str) -> bool:
     """Send alert to the user
 
@@ -99,196 +233,488 @@ def send_alert(bot: telebot.TeleBot, chat_id: str, message: str, location: str)
         location (str): Location of the alert
 
     Returns:
-        bool: True if message is sent successfully, False otherwise
+        bool: True if message is sent successfully, False if the user blocked the bot or the chat is gone
+
+    Raises:
+        telebot.apihelper.ApiTelegramException: On rate limits (429) and other errors that are not permanent
+            for the chat, so the message can be retried
     """
 
     try:
-        markup = telebot.types.InlineKeyboardMarkup()
-        markup.row_width = 1
-        markup.add(
-            telebot.types.InlineKeyboardButton(
-                "Visit knmi.nl", url=f"https://www.knmi.nl/nederland-nu/weer/waarschuwingen/{location.lower()}"
-            )
-        )
-
-        bot.send_message(chat_id, message, parse_mode="Markdown", reply_markup=markup)
+        bot.send_message(chat_id, message, parse_mode="Markdown", reply_markup=make_reply_markup(location))
         return True
     except telebot.apihelper.ApiTelegramException as e:
-        logger.error(f"Failed to send message to {chat_id}: {e}")
+        if not is_unreachable(e):
+            raise
+        logger.info(f"User {chat_id} is unreachable: {e}")
         return False
 
 
-def soft_delete_user(user_id: str) -> bool:
-    """Soft delete the user
+def soft_delete_users(user_ids: typing.Collection[str], chunk_size: int = 500) -> bool:
+    """Soft delete the users, in a request per `chunk_size` users
 
     Args:
-        user_id (str): User id
+        user_ids (typing.Collection[str]): User ids
+        chunk_size (int, optional): Number of users per request. Defaults to 500.
+
+    Returns:
+        bool: True if all users are soft deleted, False otherwise
     """
-    logger.info(f"Soft deleting user: {user_id}")
+    user_ids = sorted(user_ids)
+    logger.info(f"Soft deleting {len(user_ids)} users")
     try:
-        r = requests.patch(
-            f"{API_BASE}/users",
-            params={"telegram_id": f"eq.{user_id}"},
-            headers={"Content-Type": "application/json"},
-            json={"is_deleted": True},
-            timeout=10,
-        )
-        r.raise_for_status()
-        logger.info(f"User {user_id} soft deleted")
+        for i in range(0, len(user_ids), chunk_size):
+            quoted_ids = ",".join(f'"{user_id}"' for user_id in user_ids[i : i + chunk_size])
+            r = requests.patch(
+                f"{API_BASE}/users",
+                params={"telegram_id": f"in.({quoted_ids})"},
+                headers={"Content-Type": "application/json"},
+                json={"is_deleted": True},
+                timeout=10,
+            )
+            r.raise_for_status()
+        logger.info(f"{len(user_ids)} users soft deleted")
         return True
     except Exception as e:
-        logger.error(f"Failed to soft delete user {user_id}: {e}")
+        logger.error(f"Failed to soft delete users {user_ids}: {e}")
         return False
 
 
-def get_on_going_alerts(location: str) -> typing.List[dict]:
-    """Get on going alerts
+def defer_soft_delete(user_ids: typing.Iterable[str]) -> None:
+    """Queue unreachable users to be soft deleted by the next flush_soft_deletes
+
+    They are removed from the subscriber index right away, so no new deliveries are queued for them.
+
+    Args:
+        user_ids (typing.Iterable[str]): User ids
+    """
+    with pending_deletes_lock:
+        for user_id in user_ids:
+            pending_deletes.add(user_id)
+            subscribers.remove(user_id)
+
+
+def flush_soft_deletes() -> None:
+    """Soft delete the queued unreachable users in bulk, they are kept queued if it fails"""
+    global last_deletes_flush
+
+    with pending_deletes_lock:
+        user_ids = set(pending_deletes)
+        pending_deletes.clear()
+        last_deletes_flush = time.monotonic()
+
+    if user_ids and not soft_delete_users(user_ids):
+        with pending_deletes_lock:
+            pending_deletes.update(user_ids)
+
+
+def check_alert(location: str, alert: dict, previous: typing.Optional[str]) -> str:
+    """Check the status of the alert against the alert state, keyed by (region, phenomenon)
 
     Args:
         location (str): Location of the alert
+        alert (dict): Alert information
+        previous (typing.Optional[str]): Last known fingerprint of the alert, see alert_state.fingerprint
 
     Returns:
-        typing.List[dict]: List of on going alerts
+        str: Status of the alert: "new", "escalated", "updated", "unchanged" or "ended"
     """
+    return classify(alert, previous)
 
-    r = requests.get(
-        f"{API_BASE}/alerts",
-        params={
-            "region": f"eq.{location}",
-            "end_time": f"gte.{time.strftime('%Y-%m-%d %H:%M:%S')}",
-        },
-        headers={"Content-Type": "application/json"},
-        timeout=10,
-    )
 
-    if r.status_code != 200:
-        return []
+def iter_users(page_size: int = SUBSCRIBERS_PAGE_SIZE) -> typing.Iterator[dict]:
+    """Iterate over all users that are not deleted, fetched page by page
 
-    return r.json()
+    Args:
+        page_size (int, optional): Number of users per request. Defaults to SUBSCRIBERS_PAGE_SIZE.
+
+    Yields:
+        dict: User with the telegram_id, region and notify_* columns
+    """
+    last_id = None
+    while True:
+        params = {"select": USER_COLUMNS, "is_deleted": "eq.false", "order": "telegram_id", "limit": page_size}
+        if last_id is not None:
+            params["telegram_id"] = f"gt.{last_id}"
+
+        r = requests.get(f"{API_BASE}/users", params=params, headers={"Content-Type": "application/json"}, timeout=60)
+        r.raise_for_status()
+        users = r.json()
+
+        yield from users
+        if len(users) < page_size:
+            return
+        last_id = users[-1]["telegram_id"]
 
 
-def create_or_update_alert(old_alert: dict, new_alert: dict) -> None:
-    """Update the alert
+def load_subscribers(index: SubscriberIndex) -> None:
+    """Load all users into the subscriber index
 
     Args:
-        old_alert (dict): Old alert information
-        new_alert (dict): New alert information
+        index (SubscriberIndex): Subscriber index
     """
+    start = time.perf_counter()
+    index.load(iter_users())
+    logger.info(f"Loaded {len(index)} subscribers in {time.perf_counter() - start:.1f}s")
+
 
-    new_alert["description"] = new_alert.pop("text")["EN"]
+def refresh_subscribers(index: SubscriberIndex, telegram_ids: typing.Collection[str]) -> None:
+    """Update the changed users in the subscriber index
+
+    Args:
+        index (SubscriberIndex): Subscriber index
+        telegram_ids (typing.Collection[str]): Telegram ids of the changed users
+    """
+    quoted_ids = ",".join(f'"{telegram_id}"' for telegram_id in telegram_ids)
 
-    r = requests.post(
-        f"{API_BASE}/alerts",
-        headers={"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates"},
-        json=new_alert,
+    r = requests.get(
+        f"{API_BASE}/users",
+        params={"select": USER_COLUMNS, "telegram_id": f"in.({quoted_ids})"},
+        headers={"Content-Type": "application/json"},
         timeout=10,
     )
+    r.raise_for_status()
+
+    users = r.json()
+    for user in users:
+        index.update(user)
+    for telegram_id in set(telegram_ids) - {user["telegram_id"] for user in users}:
+        index.remove(telegram_id)
 
-    if r.status_code != 204:
-        logger.error(f"Failed to update alert: {old_alert}")
 
+def watch_user_changes(r: redis.Redis, index: SubscriberIndex, last_id: str) -> None:
+    """Keep the subscriber index up to date with the user changes stream, forever
 
-def check_alert(location: str, alert: dict) -> str:
-    # r = requests.get(
-    #     f"http://db_api:3000/alerts?location=eq.{location}"
-    # )
+    Args:
+        r (redis.Redis): Redis client
+        index (SubscriberIndex): Subscriber index, loaded when the stream was at `last_id`
+        last_id (str): Id of the last change included in the index
+    """
+    reloaded_at = time.monotonic()
 
-    # alert = {
-    #     "phenomenon_name": "Windstoten",
-    #     "code": "YELLOW",
-    #     "start_time": "2024-12-31 23:00:00+01:00",
-    #     "end_time": "2025-01-01 11:00:00+01:00",
-    #     "text": {"NL": "Kans op zware windstoten van 75-90 km/u.", "EN": "Risk heavy gusts of 75-90 km/hr."},
-    # }
+    while True:
+        try:
+            if time.monotonic() - reloaded_at > SUBSCRIBERS_RELOAD_SECONDS:
+                last_id = get_last_id(r, USER_CHANGES_STREAM)
+                load_subscribers(index)
+                reloaded_at = time.monotonic()
+
+            response = r.xread({USER_CHANGES_STREAM: last_id}, count=1000, block=USER_CHANGES_BLOCK_MS)
+            for _, changes in response or []:
+                refresh_subscribers(index, {fields["telegram_id"] for _, fields in changes})
+                last_id = changes[-1][0]
+                logger.info(f"Updated {len(changes)} subscribers")
+        except redis.exceptions.ConnectionError:
+            logger.error("Redis connection error")
+            time.sleep(1)
+        except Exception as e:
+            logger.error(f"Failed to update subscribers: {e}")
+            time.sleep(1)
 
-    # on_going_alets = get_on_going_alerts(location)
 
-    # logger.info(f"on_going_alets: {on_going_alets}")
+def match_users(index: SubscriberIndex, alerts: typing.Dict[str, typing.List[dict]]) -> typing.Dict[tuple, typing.List[str]]:
+    """Match the users to the alerts of their region and severity settings
 
-    # for old_alert in on_going_alets:
-    #     if old_alert["phenomenon_name"] == alert["phenomenon_name"]:
-    #         if old_alert == alert:
-    #             return "unchanged"
-    #         else:
-    #             create_or_update_alert(old_alert, alert)
-    #             return "upadted"
+    Users that get the same alerts are grouped, so the message of a group is rendered once.
 
-    # create_or_update_alert({}, alert)
-    return "new"
+    Args:
+        index (SubscriberIndex): Subscriber index
+        alerts (typing.Dict[str, typing.List[dict]]): New alerts per location
 
+    Returns:
+        typing.Dict[tuple, typing.List[str]]: Chat ids per (location, indices of the alerts in the location)
     """
-    get on_going alerts
-    check if alert is in the on_going alerts
-    if yes:
-        check if the alert is updated
-        if yes:
-            return updated
-        else:
-            return unchanged
-    else:
-        return new
-    """
+    groups = collections.defaultdict(list)
+    for location, location_alerts in alerts.items():
+        codes = [alert["code"].lower() for alert in location_alerts]
+        for wanted, chat_ids in index.recipients(location, codes).items():
+            matched = tuple(i for i, code in enumerate(codes) if code in wanted)
+            groups[(location, matched)].extend(chat_ids)
+    return groups
 
 
-def get_users_interested_in_alert(location: str, alert: dict) -> typing.List[dict]:
-    """Get users interested in the alert
+def enqueue_alerts(r: redis.Redis, sequence: int, alerts: typing.Dict[str, typing.List[dict]]) -> int:
+    """Turn the new alerts of a record into a delivery job per interested user
+
+    Every user gets one message with all alerts of the record that match the user's settings.
 
     Args:
-        location (str): Location of the alert
-        alert (dict): Alert information
+        r (redis.Redis): Redis client
+        sequence (int): Sequence number of the record
+        alerts (typing.Dict[str, typing.List[dict]]): New alerts per location
 
     Returns:
-        typing.List[dict]: List of users interested in the alert
+        int: Number of jobs
     """
+    count = 0
+    for (location, matched), chat_ids in match_users(subscribers, alerts).items():
+        matched_alerts = [alerts[location][i] for i in matched]
+        message_id = store_message(r, f"{DELIVERY_STREAM}:message", make_alerts_message(matched_alerts), DELIVERY_TTL)
+        phenomena = "+".join(alert["phenomenon_name"] for alert in matched_alerts)
+
+        count += enqueue_jobs(
+            r,
+            DELIVERY_STREAM,
+            (
+                {
+                    "chat_id": chat_id,
+                    "location": location,
+                    "message_id": message_id,
+                    "key": make_idempotency_key(sequence, location, phenomena, chat_id),
+                }
+                for chat_id in chat_ids
+            ),
+        )
+
+    return count
 
-    r = requests.get(
-        f"{API_BASE}/users",
-        params={"region": f"eq.{location}", "is_deleted": "eq.false", f"notify_{alert['code'].lower()}": "eq.true"},
-        headers={"Content-Type": "application/json"},
-        timeout=10,
-    )
 
-    if r.status_code != 200:
-        return []
+def queue_region_reports(r: redis.Redis, alerts: typing.Dict[str, typing.List[dict]]) -> None:
+    """Queue the reports of the regions whose content changed, they are stored by store_region_reports
+
+    A queued report replaces the one of the region that wasn't stored yet.
+
+    Args:
+        r (redis.Redis): Redis client
+        alerts (typing.Dict[str, typing.List[dict]]): Annotated alerts per location
+    """
+    today = datetime.date.today().isoformat()
+    reports = {
+        location: [
+            {k: v for k, v in alert.items() if k != "status"} for alert in location_alerts if alert["status"] != "ended"
+        ]
+        for location, location_alerts in alerts.items()
+    }
+    hashes = {location: hash_region_report(report, today) for location, report in reports.items()}
+
+    stored = dict(zip(hashes, r.hmget(REPORT_STATE_KEY, list(hashes)))) if hashes else {}
+    changed = [location for location, report_hash in hashes.items() if stored.get(location) != report_hash]
+    if not changed:
+        return
+
+    with r.pipeline() as pipe:
+        pipe.hset(
+            PENDING_REPORTS_KEY,
+            mapping={location: json.dumps({"issue_date": today, "alerts": reports[location]}) for location in changed},
+        )
+        pipe.hset(REPORT_STATE_KEY, mapping={location: hashes[location] for location in changed})
+        pipe.execute()
 
-    return r.json()
 
+def store_region_reports(r: redis.Redis) -> None:
+    """Store the queued reports of the regions, in a single request per issue date
 
-def process_message(bot: telebot.TeleBot, record: dict) -> None:
-    """Process incoming  messages from the pub/sub
+    The reports stay queued when the request fails, so they are stored by the next call.
 
     Args:
-        bot (telebot.TeleBot): Telegram bot client
-        record (dict): Record from the pub/sub
+        r (redis.Redis): Redis client
     """
+    pending = r.hgetall(PENDING_REPORTS_KEY)
+    if not pending:
+        return
+
+    reports = collections.defaultdict(dict)
+    for location, value in pending.items():
+        report = json.loads(value)
+        reports[report["issue_date"]][location] = report["alerts"]
+    for issue_date, date_reports in reports.items():
+        upsert_reports_for_the_regions(date_reports, issue_date)
+
+    def remove_stored(pipe: redis.client.Pipeline) -> None:
+        # A report queued in the meantime, e.g. by another replica, stays queued
+        current = dict(zip(pending, pipe.hmget(PENDING_REPORTS_KEY, list(pending))))
+        stored = [location for location, value in current.items() if value == pending[location]]
+        pipe.multi()
+        if stored:
+            pipe.hdel(PENDING_REPORTS_KEY, *stored)
+
+    r.transaction(remove_stored, PENDING_REPORTS_KEY)
+
 
-    logger.info(f"Processing message: {record}")
-    for location, alerts in record.items():
-        if len(alerts) == 0:
-            logger.info(f"No alerts found for {location}")
-            continue
+def process_message(r: redis.Redis, record: dict) -> None:
+    """Process incoming  messages from the changes stream
 
-        create_report_for_the_region(location, alerts)
+    The deliveries are not sent here but queued, see deliver_jobs. A record processed again after a crash
+    queues its deliveries again, the idempotency keys keep them from being sent twice. The reports of the regions
+    are queued after the deliveries and stored afterwards, see store_region_reports, so a PostgREST outage doesn't
+    hold up the alerts. Regions for which a newer record was already applied are skipped, so a record replayed late
+    doesn't overwrite their state.
 
+    Args:
+        r (redis.Redis): Redis client
+        record (dict): Record from the changes stream, contains the sequence number and the changed alerts per region
+    """
+
+    logger.info(f"Processing message #{record['sequence']}: {record['alerts']}")
+    locations = list(record["alerts"])
+    applied = dict(zip(locations, r.hmget(APPLIED_SEQUENCE_KEY, locations))) if locations else {}
+    stale = [
+        location for location, sequence in applied.items() if sequence is not None and int(sequence) >= record["sequence"]
+    ]
+    if stale:
+        logger.warning(f"Skipping {', '.join(stale)} of message #{record['sequence']}, a newer message was applied")
+    record_alerts = {location: alerts for location, alerts in record["alerts"].items() if location not in stale}
+
+    fields = [
+        state_field(location, alert["phenomenon_name"]) for location, alerts in record_alerts.items() for alert in alerts
+    ]
+    states = get_alert_states(r, ALERT_STATE_KEY, fields)
+    new_states = {}
+
+    new_alerts = collections.defaultdict(list)
+    for location, alerts in record_alerts.items():
         for alert in alerts:
             logger.info(f"Alert: {alert}")
-            match check_alert(location, alert):
-                case "new":
-                    users = get_users_interested_in_alert(location, alert)
-                    alert_message = make_alert_message(alert)
-                    for user in users:
-                        is_sent = send_alert(bot, user["telegram_id"], alert_message, location)
-                        if not is_sent:
-                            soft_delete_user(user["telegram_id"])
-                    logger.info(f"Alert sent to {len(users)} users")
+            field = state_field(location, alert["phenomenon_name"])
+            match check_alert(location, alert, states.get(field)):
+                case "new" | "escalated":
+                    new_alerts[location].append(alert)
+                    new_states[field] = fingerprint(alert)
                 case "updated":
-                    pass
+                    new_states[field] = fingerprint(alert)
                 case "unchanged":
                     logger.info("Alert unchanged. Skipping")
-                    continue
+                    if states.get(field) is None:
+                        new_states[field] = fingerprint(alert)
+                case "ended":
+                    logger.info(f"Alert {alert['phenomenon_name']} ended for {location}")
+                    new_states[field] = None
                 case _:
                     logger.error("Unknown alert status")
 
+    if new_alerts:
+        count = enqueue_alerts(r, record["sequence"], new_alerts)
+        logger.info(f"Alerts queued for {count} users")
+
+    # Stored after the deliveries are queued, so a record processed again after a crash still queues them
+    if new_states:
+        save_alert_states(r, ALERT_STATE_KEY, new_states)
+    if record_alerts:
+        queue_region_reports(r, record_alerts)
+        r.hset(APPLIED_SEQUENCE_KEY, mapping={location: record["sequence"] for location in record_alerts})
+
+
+def deliver_jobs(bot: telebot.TeleBot, r: redis.Redis, jobs: typing.List[Job]) -> None:
+    """Send the messages of the delivery jobs
+
+    Delivered jobs and jobs of unreachable users are acked, failed jobs stay pending and are retried after
+    DELIVERY_RETRY_AFTER_MS. Jobs that were already delivered (a retry after a crash between sending and acking)
+    are acked without sending them again.
+
+    Args:
+        bot (telebot.TeleBot): Telegram bot client
+        r (redis.Redis): Redis client
+        jobs (typing.List[Job]): Delivery jobs
+    """
+    delivered = get_delivered(r, f"{DELIVERY_STREAM}:delivered", [fields["key"] for _, fields in jobs])
+    messages = get_messages(r, f"{DELIVERY_STREAM}:message", (fields["message_id"] for _, fields in jobs))
+
+    expired = [job for job in jobs if job[1]["key"] not in delivered and job[1]["message_id"] not in messages]
+    dead_letter_jobs(r, DELIVERY_STREAM, DELIVERY_GROUP, DELIVERY_DEAD_LETTER, expired, "message expired")
+
+    done = [job_id for job_id, fields in jobs if fields["key"] in delivered]
+    todo = [job for job in jobs if job[1]["key"] not in delivered and job[1]["message_id"] in messages]
+
+    statuses = fan_out(
+        lambda job: send_alert(bot, job[1]["chat_id"], messages[job[1]["message_id"]], job[1]["location"]),
+        todo,
+        limiter,
+        DELIVERY_WORKERS,
+        chat_id=lambda job: job[1]["chat_id"],
+    )
+
+    sent = [fields["key"] for (_, fields), status in zip(todo, statuses) if status == DELIVERED]
+    mark_delivered(r, f"{DELIVERY_STREAM}:delivered", sent, DELIVERY_TTL)
+
+    defer_soft_delete(fields["chat_id"] for (_, fields), status in zip(todo, statuses) if status == UNREACHABLE)
+
+    done.extend(job_id for (job_id, _), status in zip(todo, statuses) if status != FAILED)
+    ack_jobs(r, DELIVERY_STREAM, DELIVERY_GROUP, done)
+
+    if todo:
+        logger.info(f"Delivered {len(sent)} of {len(todo)} messages")
+
+
+def run_deliveries(bot: telebot.TeleBot, r: redis.Redis, block_ms: int = 5000) -> None:
+    """Drain the delivery queue forever, together with the other notifier replicas
+
+    Stale pending jobs are retried first, jobs that failed DELIVERY_MAX_ATTEMPTS times go to the dead-letter list.
+    Unreachable users are soft deleted in bulk, see flush_soft_deletes.
+
+    Args:
+        bot (telebot.TeleBot): Telegram bot client
+        r (redis.Redis): Redis client
+        block_ms (int, optional): Milliseconds to wait for new jobs. Defaults to 5000.
+    """
+    create_group(r, DELIVERY_STREAM, DELIVERY_GROUP)
+
+    while True:
+        try:
+            claimed = claim_stale_jobs(
+                r, DELIVERY_STREAM, DELIVERY_GROUP, DELIVERY_CONSUMER, DELIVERY_RETRY_AFTER_MS, DELIVERY_BATCH_SIZE
+            )
+            exhausted = [job for job, attempts in claimed if attempts > DELIVERY_MAX_ATTEMPTS]
+            if exhausted:
+                logger.error(f"Giving up {len(exhausted)} deliveries after {DELIVERY_MAX_ATTEMPTS} attempts")
+                dead_letter_jobs(r, DELIVERY_STREAM, DELIVERY_GROUP, DELIVERY_DEAD_LETTER, exhausted, "too many attempts")
+
+            jobs = [job for job, attempts in claimed if attempts <= DELIVERY_MAX_ATTEMPTS]
+            if not claimed:
+                jobs = read_jobs(r, DELIVERY_STREAM, DELIVERY_GROUP, DELIVERY_CONSUMER, DELIVERY_BATCH_SIZE, block_ms)
+
+            if jobs:
+                deliver_jobs(bot, r, jobs)
+
+            # Unreachable users are soft deleted once the queue is drained, or in between for long deliveries
+            if pending_deletes and (
+                not jobs
+                or len(pending_deletes) >= SOFT_DELETE_BATCH_SIZE
+                or time.monotonic() - last_deletes_flush > SOFT_DELETE_INTERVAL
+            ):
+                flush_soft_deletes()
+        except redis.exceptions.ConnectionError:
+            logger.error("Redis connection error")
+            time.sleep(1)
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            time.sleep(1)
+
+
+def process_records(r: redis.Redis, records: typing.List[Job]) -> typing.List[Job]:
+    """Process records of the changes stream in order, each one is acked as soon as it is processed
+
+    Stops at the first record that fails, so the records after it are not applied before it. The queued reports of
+    the regions are stored afterwards, also when there are no records, so they are retried until they are stored.
+
+    Args:
+        r (redis.Redis): Redis client
+        records (typing.List[Job]): Records of the changes stream
+
+    Returns:
+        typing.List[Job]: The failed record and the records after it, to retry them; empty if all were processed
+    """
+    for index, (record_id, fields) in enumerate(records):
+        try:
+            process_message(r, json.loads(fields["data"]))
+            r.xack(CHANGES_STREAM, DELIVERY_GROUP, record_id)
+        except redis.exceptions.ConnectionError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to process record {record_id}: {e}")
+            records = records[index:]
+            break
+    else:
+        records = []
+
+    try:
+        store_region_reports(r)
+    except redis.exceptions.ConnectionError:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to store the region reports: {e}")
+
+    return records
+
 
 def main() -> None:
     """Main function"""
@@ -297,21 +723,71 @@ def main() -> None:
     redis_client = create_redis_client()
     bot = create_bot_client()
 
-    p = redis_client.pubsub(ignore_subscribe_messages=True)
-    p.subscribe(REDIS_CHANNEL)
-
     while True:
         try:
-            message = p.get_message()
+            last_user_change = get_last_id(redis_client, USER_CHANGES_STREAM)
+            load_subscribers(subscribers)
+            break
+        except Exception as e:
+            logger.error(f"Failed to load subscribers: {e}")
+            time.sleep(5)
+
+    threading.Thread(
+        target=watch_user_changes,
+        args=(redis_client, subscribers, last_user_change),
+        name="subscriber-watcher",
+        daemon=True,
+    ).start()
+    threading.Thread(target=run_deliveries, args=(bot, redis_client), name="delivery-worker", daemon=True).start()
+
+    create_group(redis_client, CHANGES_STREAM, DELIVERY_GROUP)
+    # Records read but not acked before a restart are processed first
+    records = read_jobs(redis_client, CHANGES_STREAM, DELIVERY_GROUP, DELIVERY_CONSUMER, CHANGES_BATCH_SIZE, None, "0")
+    # Id and number of failed attempts of the record that blocks the records after it
+    failed_id, failures = None, 0
 
-            if message:
-                process_message(bot, json.loads(message["data"]))
-            else:
-                time.sleep(1)
+    while True:
+        try:
+            if not records:
+                claimed = claim_stale_jobs(
+                    redis_client,
+                    CHANGES_STREAM,
+                    DELIVERY_GROUP,
+                    DELIVERY_CONSUMER,
+                    DELIVERY_RETRY_AFTER_MS,
+                    CHANGES_BATCH_SIZE,
+                )
+                exhausted = [record for record, attempts in claimed if attempts > DELIVERY_MAX_ATTEMPTS]
+                dead_letter_jobs(
+                    redis_client, CHANGES_STREAM, DELIVERY_GROUP, CHANGES_DEAD_LETTER, exhausted, "too many attempts"
+                )
+                records = [record for record, attempts in claimed if attempts <= DELIVERY_MAX_ATTEMPTS]
+
+            if not records:
+                # Blocks in Redis until a record arrives, a backlog is read in batches
+                records = read_jobs(
+                    redis_client, CHANGES_STREAM, DELIVERY_GROUP, DELIVERY_CONSUMER, CHANGES_BATCH_SIZE, CHANGES_BLOCK_MS
+                )
+
+            records = process_records(redis_client, records)
+            if records:
+                failures = failures + 1 if records[0][0] == failed_id else 1
+                failed_id = records[0][0]
+                if failures < DELIVERY_MAX_ATTEMPTS:
+                    time.sleep(CHANGES_RETRY_SECONDS)
+                else:
+                    logger.error(f"Giving up record {failed_id} after {failures} attempts")
+                    dead_letter_jobs(
+                        redis_client, CHANGES_STREAM, DELIVERY_GROUP, CHANGES_DEAD_LETTER, records[:1], "too many attempts"
+                    )
+                    records = records[1:]
         except redis.exceptions.ConnectionError:
             logger.error("Redis connection error")
+            records = []
+            time.sleep(1)
         except Exception as e:
             logger.error(f"Error: {e}")
+            records = []
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+import array
+import bisect
+import re
+import threading
+import typing
+
+# Same order as the province enum of the database
+REGIONS = (
+    "Drenthe",
+    "Flevoland",
+    "Friesland",
+    "Gelderland",
+    "Groningen",
+    "Limburg",
+    "Noord-Brabant",
+    "Noord-Holland",
+    "Overijssel",
+    "Utrecht",
+    "Zeeland",
+    "Zuid-Holland",
+    "Waddenzee",
+    "IJsselmeergebied",
+    "Waddeneilanden",
+)
+CODES = ("red", "orange", "yellow")
+
+_REGION_BITS = {region: i + 1 for i, region in enumerate(REGIONS)}
+_CODE_BITS = {code: 1 << (i + 4) for i, code in enumerate(CODES)}
+
+
+def encode_user(user: dict) -> int:
+    """Pack the region and the notification settings of a user in a byte
+
+    The low 4 bits hold the region (0 is no region), the next 3 bits the notify_red, notify_orange and notify_yellow flags.
+
+    Args:
+        user (dict): User with the region and notify_* columns
+
+    Returns:
+        int: Packed state, 0 if the user can't get any alert
+    """
+    region = _REGION_BITS.get(user.get("region") or "", 0)
+    codes = sum(bit for code, bit in _CODE_BITS.items() if user.get(f"notify_{code}"))
+    return region | codes if region and codes else 0
+
+
+class SubscriberIndex:
+    """Region x severity index of the users that get alerts, kept in two arrays instead of a list of dicts
+
+    Telegram ids are kept sorted in an array of 64-bit integers, the packed state of every user (see encode_user)
+    in a bytearray at the same position: about 9 bytes per user. Recipients of a region are found by translating
+    the states with a lookup table, without a network call.
+    """
+
+    def __init__(self):
+        self._ids = array.array("q")
+        self._states = bytearray()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def load(self, users: typing.Iterable[dict]) -> None:
+        """Replace the index with the given users
+
+        Args:
+            users (typing.Iterable[dict]): Users with the telegram_id, region and notify_* columns
+        """
+        # Telegram ids fit in 52 bits, so id and state are packed in a single 64-bit integer to sort them together
+        packed = array.array("q")
+        for user in users:
+            state = 0 if user.get("is_deleted") else encode_user(user)
+            if state:
+                packed.append(int(user["telegram_id"]) << 8 | state)
+
+        packed = array.array("q", sorted(packed))
+        ids = array.array("q", (value >> 8 for value in packed))
+        states = bytearray(value & 0xFF for value in packed)
+
+        with self._lock:
+            self._ids, self._states = ids, states
+
+    def update(self, user: dict) -> None:
+        """Add, update or remove a single user
+
+        Args:
+            user (dict): User with the telegram_id, region and notify_* columns
+        """
+        state = 0 if user.get("is_deleted") else encode_user(user)
+        telegram_id = int(user["telegram_id"])
+
+        with self._lock:
+            i = bisect.bisect_left(self._ids, telegram_id)
+            found = i < len(self._ids) and self._ids[i] == telegram_id
+            if found and state:
+                self._states[i] = state
+            elif found:
+                del self._ids[i]
+                del self._states[i]
+            elif state:
+                self._ids.insert(i, telegram_id)
+                self._states.insert(i, state)
+
+    def remove(self, telegram_id: str) -> None:
+        """Remove a user, e.g. after the user was soft deleted
+
+        Args:
+            telegram_id (str): Telegram id of the user
+        """
+        self.update({"telegram_id": telegram_id, "is_deleted": True})
+
+    def recipients(self, region: str, codes: typing.Iterable[str]) -> typing.Dict[typing.FrozenSet[str], typing.List[str]]:
+        """Get the users of a region that want alerts of the given codes
+
+        Args:
+            region (str): Region
+            codes (typing.Iterable[str]): Codes of the alerts, e.g. "yellow"
+
+        Returns:
+            typing.Dict[typing.FrozenSet[str], typing.List[str]]: Telegram ids per subset of the codes the users want
+        """
+        region_bits = _REGION_BITS.get(region)
+        wanted = sum(_CODE_BITS[code] for code in set(codes) if code in _CODE_BITS)
+        if not region_bits or not wanted:
+            return {}
+
+        # Maps every state to the codes of interest the user wants, 0 for users of other regions
+        table = bytes((state & wanted) >> 4 if state & 0x0F == region_bits else 0 for state in range(256))
+
+        with self._lock:
+            matched = self._states.translate(table)
+            ids = self._ids
+
+            groups = {}
+            for mask in range(1, 8):
+                positions = [m.start() for m in re.finditer(re.escape(bytes([mask])), matched)]
+                if positions:
+                    key = frozenset(code for code, bit in _CODE_BITS.items() if (bit >> 4) & mask)
+                    groups[key] = [str(ids[i]) for i in positions]
+
+        return groups
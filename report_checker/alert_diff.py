@@ -0,0 +1,52 @@
+import json
+
+
+def normalize_alerts(alerts: dict) -> dict:
+    """Normalize the alerts to the form they are published in, e.g. datetimes become strings
+
+    Args:
+        alerts (dict): Alerts as returned by get_alerts
+
+    Returns:
+        dict: Returns the alerts as they are decoded on the other side of the channel
+    """
+    return json.loads(json.dumps(alerts, default=str))
+
+
+def diff_alerts(previous: dict, current: dict) -> dict:
+    """Compute the changes between two alert snapshots per (region, phenomenon)
+
+    Every alert of a changed region is annotated with a status: "new", "updated", "unchanged" or "ended".
+    Ended alerts carry the content of the previous snapshot. Regions without changes are left out.
+
+    Args:
+        previous (dict): Last published snapshot, normalized
+        current (dict): Current snapshot, normalized
+
+    Returns:
+        dict: Returns the annotated alerts of every changed region
+    """
+    result = {}
+
+    for region in [*current, *(region for region in previous if region not in current)]:
+        previous_alerts = {alert["phenomenon_name"]: alert for alert in previous.get(region, [])}
+        current_alerts = {alert["phenomenon_name"]: alert for alert in current.get(region, [])}
+
+        changes = []
+        for phenomenon, alert in current_alerts.items():
+            if phenomenon not in previous_alerts:
+                status = "new"
+            elif previous_alerts[phenomenon] != alert:
+                status = "updated"
+            else:
+                status = "unchanged"
+            changes.append({**alert, "status": status})
+
+        for phenomenon, alert in previous_alerts.items():
+            if phenomenon not in current_alerts:
+                changes.append({**alert, "status": "ended"})
+
+        if any(change["status"] != "unchanged" for change in changes):
+            result[region] = changes
+
+    return result
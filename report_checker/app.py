@@ -1,34 +1,126 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import io
 import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import queue
+import re
+import shutil
 import ssl
+import tempfile
+import threading
+import time
 import typing
 
 import paho.mqtt.client as mqtt_client
 import paho.mqtt.properties as properties
 import redis  # ty: ignore[unresolved-import]
 import requests
+from alert_diff import diff_alerts, normalize_alerts
 from get_docker_secret import get_docker_secret
+from http_session import create_session
 from knmi_alerts import get_alerts
+from report_archive import ReportArchive
+from report_cache import (
+    HashingReader,
+    get_last_alerts,
+    get_last_alerts_hash,
+    hash_alerts,
+    hash_report,
+    is_known_report,
+    remember_report,
+    set_last_alerts,
+    set_last_alerts_hash,
+)
 
 BROKER_DOMAIN = "mqtt.dataplatform.knmi.nl"
-NOTIFICATION_CLIENT_ID = get_docker_secret("notification_client_id")
-NOTIFICATION_TOKEN = get_docker_secret("notification_token")
-API_TOKEN = get_docker_secret("open_data_api_token")
 TOPIC = "dataplatform/file/v1/waarschuwingen_nederland_48h/1.0/#"
 PROTOCOL = mqtt_client.MQTTv5
 
 
+# Reports waiting for the worker, when the queue is full the oldest report is dropped as every report is a full snapshot
+REPORT_QUEUE_SIZE = int(os.getenv("REPORT_QUEUE_SIZE", "8"))
+# "process" parses the reports outside of the GIL of the MQTT network loop, "thread" keeps them in this process
+PARSE_POOL = os.getenv("PARSE_POOL", "process")
+PARSE_POOL_WORKERS = int(os.getenv("PARSE_POOL_WORKERS", "1"))
+# "buffered" downloads the whole report before parsing it in the pool, "stream" parses the report in chunks while it
+# is downloaded, which bounds the memory by the chunk size but parses in the worker thread and can't skip the parse
+# of a known report
+DOWNLOAD_MODE = os.getenv("DOWNLOAD_MODE", "buffered")
+
+# Every new report is archived compressed in this directory, archiving is disabled when it is not set
+REPORT_ARCHIVE_DIR = os.getenv("REPORT_ARCHIVE_DIR")
+REPORT_ARCHIVE_MAX_AGE_DAYS = int(os.getenv("REPORT_ARCHIVE_MAX_AGE_DAYS", "90"))
+REPORT_ARCHIVE_MAX_BYTES = int(os.getenv("REPORT_ARCHIVE_MAX_BYTES", str(512 * 1024 * 1024)))
+
 REDIS_HOST = "redis"
 REDIS_CHANNEL = os.getenv("REDIS_CHANNEL")
+REPORT_CACHE_KEY = f"{REDIS_CHANNEL}:report_hashes"
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))
+LAST_ALERTS_HASH_KEY = f"{REDIS_CHANNEL}:last_alerts_hash"
+LAST_ALERTS_KEY = f"{REDIS_CHANNEL}:last_alerts"
+SEQUENCE_KEY = f"{REDIS_CHANNEL}:sequence"
+NEWEST_REPORT_KEY = f"{REDIS_CHANNEL}:newest_report"
+REPORT_STATS_KEY = f"{REDIS_CHANNEL}:report_stats"
+# The changes are published on a Redis Stream, so the notifier can resume from its last acked record after a restart
+CHANGES_STREAM = f"{REDIS_CHANNEL}:changes"
+CHANGES_STREAM_MAXLEN = int(os.getenv("CHANGES_STREAM_MAXLEN", "10000"))
+
+REPORT_TIME_PATTERN = re.compile(r"_(\d{12})\.xml$")
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
-r = redis.Redis(host=REDIS_HOST)
+
+class Clients(typing.NamedTuple):
+    """Token and connections of the worker, see set_clients"""
+
+    api_token: typing.Optional[str]
+    redis: redis.Redis
+    # Shared by the URL resolve and the download, so the connections to both hosts are reused between reports
+    session: requests.Session
+
+
+# Set up by run(), the spawned parse pool workers import this module too and must not read the secrets, connect
+# or evict from the archive
+clients: typing.Optional[Clients] = None
+archive: typing.Optional[ReportArchive] = None
+
+report_queue: queue.Queue = queue.Queue(maxsize=REPORT_QUEUE_SIZE)
+# Issue time of the newest report that is queued or processed, older notifications are superseded by it
+newest_report_time: typing.Optional[str] = None
+# Counters of processed, coalesced (superseded while queued) and skipped (superseded on arrival) reports
+report_stats: collections.Counter = collections.Counter()
+
+
+def set_clients(new_clients: Clients) -> None:
+    """Set the token and connections the reports are processed with
+
+    Args:
+        new_clients (Clients): Token and connections
+    """
+    global clients
+    clients = new_clients
+
+
+def get_clients() -> Clients:
+    """Get the token and connections the reports are processed with
+
+    Raises:
+        RuntimeError: set_clients was not called
+
+    Returns:
+        Clients: Token and connections
+    """
+    if clients is None:
+        raise RuntimeError("The clients are not set up, see set_clients")
+    return clients
 
 
 def download_report(url: str) -> io.BytesIO:
@@ -40,17 +132,73 @@ def download_report(url: str) -> io.BytesIO:
     Returns:
         io.BytesIO: In-memory report
     """
-    resp = requests.get(url, stream=True, timeout=20)
+    start = time.perf_counter()
+    resp = get_clients().session.get(url, stream=True, timeout=20)
     resp.raise_for_status()
+    first_byte = time.perf_counter() - start
+
+    report = io.BytesIO(resp.content)
+    logger.info(
+        f"Downloaded {report.getbuffer().nbytes} bytes: first byte {first_byte * 1000:.0f} ms, "
+        f"download {(time.perf_counter() - start - first_byte) * 1000:.0f} ms"
+    )
+
+    return report
 
-    return io.BytesIO(resp.content)
 
+def stream_alerts(url: str, sink: typing.Optional[typing.BinaryIO] = None) -> typing.Tuple[str, dict]:
+    """Download the report and parse it while it arrives
 
-def write_report(report: io.BytesIO, filename: str, path: pathlib.Path) -> typing.Optional[str]:
-    """Write the report to a file
+    The response body is fed in chunks to the streaming parser and hashed on the way, it is never held in memory
+    as a whole.
 
     Args:
-        report (io.BytesIO): In-memory report
+        url (str): URL to the report
+        sink (typing.Optional[typing.BinaryIO], optional): File the report is copied to. Defaults to None.
+
+    Returns:
+        typing.Tuple[str, dict]: Hash of the report and the alerts from the report
+    """
+    start = time.perf_counter()
+    with get_clients().session.get(url, stream=True, timeout=20) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+
+        report = HashingReader(resp.raw, sink)
+        alerts = get_alerts(report, engine="stream")
+        report.drain()
+
+    logger.info(f"Downloaded and parsed the report in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    return report.hexdigest(), alerts
+
+
+def archive_report(report: typing.BinaryIO, report_hash: str) -> None:
+    """Store the report in the local archive, failures are logged and don't stop the processing
+
+    Args:
+        report (typing.BinaryIO): Seekable report file, it is rewound afterwards
+        report_hash (str): Hash of the report
+    """
+    if archive is None:
+        return
+
+    try:
+        entry = archive.add(report, report_hash)
+        if entry:
+            logger.info(f"Archived report issued at {entry.issued.isoformat()} as {entry.filename}")
+    except Exception as e:
+        logger.error(f"Failed to archive the report: {e}")
+    finally:
+        # The report is parsed after archiving, from the start
+        report.seek(0)
+
+
+def write_report(report: typing.BinaryIO, filename: str, path: pathlib.Path) -> typing.Optional[str]:
+    """Write the report to a file in chunks
+
+    Args:
+        report (typing.BinaryIO): Report, e.g. in-memory report or a streamed response body
         filename (str): Name of the file
         path (pathlib.Path): Path to write the file
 
@@ -59,7 +207,7 @@ def write_report(report: io.BytesIO, filename: str, path: pathlib.Path) -> typin
     """
     full_path = path / filename
     with open(full_path, "wb") as fd:
-        fd.write(report.read())
+        shutil.copyfileobj(report, fd)
         return filename
     return None
 
@@ -73,8 +221,11 @@ def get_temporary_download_url(url: str) -> str:
     Returns:
         str: Temporary download URL
     """
-    resp = requests.get(url, headers={"Authorization": API_TOKEN}, timeout=10)
+    api_token, _, session = get_clients()
+    start = time.perf_counter()
+    resp = session.get(url, headers={"Authorization": api_token}, timeout=10)
     resp.raise_for_status()
+    logger.info(f"Resolved download URL in {(time.perf_counter() - start) * 1000:.0f} ms")
 
     return resp.json().get("temporaryDownloadUrl")
 
@@ -87,8 +238,13 @@ def connect_mqtt() -> mqtt_client.Client:
         # Subscribe here so it is automatically done after disconnect
         subscribe(c, TOPIC)
 
+    # Messages are acknowledged by the worker once the report is processed, see process_reports
     client = mqtt_client.Client(
-        mqtt_client.CallbackAPIVersion.VERSION2, client_id=NOTIFICATION_CLIENT_ID, protocol=PROTOCOL, transport="websockets"
+        mqtt_client.CallbackAPIVersion.VERSION2,
+        client_id=get_docker_secret("notification_client_id"),
+        protocol=PROTOCOL,
+        transport="websockets",
+        manual_ack=True,
     )
     client.tls_set(tls_version=ssl.PROTOCOL_TLS)
     connect_properties = properties.Properties(properties.PacketTypes.CONNECT)
@@ -97,7 +253,7 @@ def connect_mqtt() -> mqtt_client.Client:
 
     # The MQTT username is not used for authentication, only the token
     username = "token"
-    client.username_pw_set(username, NOTIFICATION_TOKEN)
+    client.username_pw_set(username, get_docker_secret("notification_token"))
     client.on_connect = on_connect
 
     client.connect(host=BROKER_DOMAIN, port=443, keepalive=60, clean_start=False, properties=connect_properties)
@@ -105,7 +261,172 @@ def connect_mqtt() -> mqtt_client.Client:
     return client
 
 
-def process_message(message: dict):
+def publish_changes(changes: dict) -> None:
+    """Publish the changed alerts with a sequence number to the changes stream
+
+    Args:
+        changes (dict): Annotated alerts of the changed regions, see diff_alerts
+    """
+    if not changes:
+        logger.info("No alert changes to publish")
+        return
+
+    r = get_clients().redis
+    sequence = r.incr(SEQUENCE_KEY)
+    r.xadd(
+        CHANGES_STREAM,
+        {"data": json.dumps({"sequence": sequence, "alerts": changes})},
+        maxlen=CHANGES_STREAM_MAXLEN,
+        approximate=True,
+    )
+    logger.info(f"Published changes #{sequence} for {len(changes)} regions")
+
+
+def create_parse_pool() -> concurrent.futures.Executor:
+    """Create the pool the reports are parsed in
+
+    Returns:
+        concurrent.futures.Executor: Process or thread pool, depending on PARSE_POOL
+    """
+    if PARSE_POOL == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=PARSE_POOL_WORKERS)
+
+    # spawn, as forking next to the MQTT network thread is not safe
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=PARSE_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def get_report_time(filename: str) -> typing.Optional[str]:
+    """Get the issue time from the report filename, e.g. knmi_waarschuwingen_202412290909.xml
+
+    Args:
+        filename (str): Name of the report file
+
+    Returns:
+        typing.Optional[str]: Issue time as YYYYMMDDHHMM, None for files that are not reports
+    """
+    match = REPORT_TIME_PATTERN.search(filename)
+    return match.group(1) if match else None
+
+
+def is_superseded(filename: str) -> bool:
+    """Check if a newer report is already queued or processed
+
+    Args:
+        filename (str): Name of the report file
+
+    Returns:
+        bool: True if the report is older than the newest known report, False otherwise
+    """
+    report_time = get_report_time(filename)
+    return report_time is not None and newest_report_time is not None and report_time < newest_report_time
+
+
+def enqueue_report(client: mqtt_client.Client, message: dict, mid: int, qos: int) -> None:
+    """Put the report notification on the queue without blocking
+
+    Notifications for reports that are not newer than the newest queued or processed report are skipped,
+    e.g. the backlog QoS=1 replays after a reconnect. When the queue is full the oldest queued notification
+    is dropped and acknowledged, only the newest report matters as every report is a full snapshot.
+
+    Args:
+        client (mqtt_client.Client): MQTT client
+        message (dict): Notification message
+        mid (int): MQTT message id
+        qos (int): MQTT quality of service of the message
+    """
+    global newest_report_time
+
+    report_time = get_report_time(message["data"]["filename"])
+    if report_time is not None:
+        if newest_report_time is not None and report_time <= newest_report_time:
+            logger.info(f"Report {message['data']['filename']} is not newer than {newest_report_time}. Skipping")
+            report_stats["skipped"] += 1
+            client.ack(mid, qos)
+            return
+
+        newest_report_time = report_time
+
+    while True:
+        try:
+            report_queue.put_nowait((message, mid, qos))
+            return
+        except queue.Full:
+            try:
+                dropped, dropped_mid, dropped_qos = report_queue.get_nowait()
+            except queue.Empty:
+                continue
+
+            logger.warning(f"Report queue is full, dropping {dropped['data']['filename']}")
+            report_stats["coalesced"] += 1
+            client.ack(dropped_mid, dropped_qos)
+            report_queue.task_done()
+
+
+def handle_report(client: mqtt_client.Client, pool: concurrent.futures.Executor, message: dict, mid: int, qos: int) -> None:
+    """Process a queued report and acknowledge its message
+
+    The message is acknowledged after its report is processed, also when processing fails, to avoid
+    replaying a broken report forever.
+
+    Args:
+        client (mqtt_client.Client): MQTT client
+        pool (concurrent.futures.Executor): Pool the reports are parsed in
+        message (dict): Notification message
+        mid (int): MQTT message id
+        qos (int): MQTT quality of service of the message
+    """
+    filename = message["data"]["filename"]
+    try:
+        if is_superseded(filename):
+            logger.info(f"Report {filename} is superseded by {newest_report_time}. Skipping")
+            report_stats["coalesced"] += 1
+            return
+
+        process_message(message, pool)
+        report_stats["processed"] += 1
+
+        if report_time := get_report_time(filename):
+            get_clients().redis.set(NEWEST_REPORT_KEY, report_time)
+    except Exception as e:
+        logger.error(f"Failed to process {filename}: {e}")
+        report_stats["failed"] += 1
+    finally:
+        client.ack(mid, qos)
+        publish_stats()
+
+
+def process_reports(client: mqtt_client.Client, pool: concurrent.futures.Executor) -> None:
+    """Process the queued reports one by one, so the latest report is always published last
+
+    Runs until the process stops, an error is logged and the worker goes on with the next report.
+
+    Args:
+        client (mqtt_client.Client): MQTT client
+        pool (concurrent.futures.Executor): Pool the reports are parsed in
+    """
+    while True:
+        message, mid, qos = report_queue.get()
+        try:
+            handle_report(client, pool, message, mid, qos)
+        except Exception as e:
+            logger.exception(f"Failed to handle {message['data']['filename']}: {e}")
+        finally:
+            report_queue.task_done()
+
+
+def publish_stats() -> None:
+    """Log the report counters and expose them in Redis"""
+    logger.info(f"Report stats: {dict(report_stats)}")
+    try:
+        if report_stats:
+            get_clients().redis.hset(REPORT_STATS_KEY, mapping=dict(report_stats))
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Failed to publish report stats: {e}")
+
+
+def process_message(message: dict, pool: typing.Optional[concurrent.futures.Executor] = None):
     if not message["data"]["filename"].endswith(".xml"):
         download_url = get_temporary_download_url(message["data"]["url"])
         txt_file = download_report(download_url)
@@ -115,10 +436,40 @@ def process_message(message: dict):
         return
 
     download_url = get_temporary_download_url(message["data"]["url"])
-    report = download_report(download_url)
-    alerts = get_alerts(report)
+    r = get_clients().redis
+
+    # KNMI republishes the report often without changes, skip the ones we have already seen
+    if DOWNLOAD_MODE == "stream":
+        # The streamed report is copied to a temporary file on disk only when it has to be archived
+        with tempfile.TemporaryFile() if archive is not None else contextlib.nullcontext() as sink:
+            report_hash, alerts = stream_alerts(download_url, sink)
+            if is_known_report(r, REPORT_CACHE_KEY, report_hash):
+                logger.info(f"Report {message['data']['filename']} is already processed. Skipping")
+                return
+            if sink is not None:
+                archive_report(sink, report_hash)
+    else:
+        report = download_report(download_url)
+        report_hash = hash_report(report)
+        if is_known_report(r, REPORT_CACHE_KEY, report_hash):
+            logger.info(f"Report {message['data']['filename']} is already processed. Skipping")
+            return
+        archive_report(report, report_hash)
+
+        alerts = pool.submit(get_alerts, report).result() if pool else get_alerts(report)
+
+    alerts = normalize_alerts(alerts)
     # ic(alerts)
-    r.publish(REDIS_CHANNEL, json.dumps(alerts, default=str))
+
+    alerts_hash = hash_alerts(alerts)
+    if alerts_hash == get_last_alerts_hash(r, LAST_ALERTS_HASH_KEY):
+        logger.info(f"Alerts in {message['data']['filename']} are unchanged. Skipping publish")
+    else:
+        publish_changes(diff_alerts(get_last_alerts(r, LAST_ALERTS_KEY), alerts))
+        set_last_alerts(r, LAST_ALERTS_KEY, alerts)
+        set_last_alerts_hash(r, LAST_ALERTS_HASH_KEY, alerts_hash)
+
+    remember_report(r, REPORT_CACHE_KEY, report_hash, REPORT_CACHE_SIZE)
 
 
 def subscribe(client: mqtt_client.Client, topic: str):
@@ -126,9 +477,8 @@ def subscribe(client: mqtt_client.Client, topic: str):
         # NOTE: Do NOT do slow processing in this function, as this will interfere with PUBACK messages for QoS=1.
         # A couple of seconds seems fine, a minute is definitely too long.
         logger.info(f"Received message on topic {message.topic}: {str(message.payload)}")
-        message = json.loads(message.payload)
 
-        process_message(message)
+        enqueue_report(c, json.loads(message.payload), message.mid, message.qos)
 
     def on_subscribe(c: mqtt_client.Client, userdata, mid, reason_codes, properties):
         logger.info(f"Subscribed to topic '{topic}'")
@@ -140,8 +490,25 @@ def subscribe(client: mqtt_client.Client, topic: str):
 
 
 def run():
+    global archive, newest_report_time
+
+    r = redis.Redis(host=REDIS_HOST)
+    set_clients(Clients(get_docker_secret("open_data_api_token"), r, create_session()))
+    if REPORT_ARCHIVE_DIR:
+        archive = ReportArchive(
+            pathlib.Path(REPORT_ARCHIVE_DIR), datetime.timedelta(days=REPORT_ARCHIVE_MAX_AGE_DAYS), REPORT_ARCHIVE_MAX_BYTES
+        )
+
+    # Skip the reports that were already processed before a restart
+    newest = r.get(NEWEST_REPORT_KEY)
+    newest_report_time = newest.decode() if newest else None
+
     client = connect_mqtt()
     client.enable_logger(logger=logger)
+
+    pool = create_parse_pool()
+    threading.Thread(target=process_reports, args=(client, pool), name="report-worker", daemon=True).start()
+
     client.loop_forever()
 
 
@@ -0,0 +1,159 @@
+import argparse
+import json
+import multiprocessing
+import pathlib
+import resource
+import statistics
+import time
+import timeit
+import typing
+
+from knmi_alerts import (
+    ENGINES,
+    detect_alerts,
+    enrich_alert,
+    file_to_bytesio,
+    get_alerts,
+    parse_report,
+    read_in_memory_file,
+    squash_alerts,
+)
+
+REPORTS_DIR = pathlib.Path(__file__).parent / "reports"
+DETECT_REPORT = REPORTS_DIR / "report_example.xml"
+# Expected alerts of the sample reports, see verify_pipeline
+EXPECTED_DIR = REPORTS_DIR / "expected"
+
+
+def measure_engine(engine: str, report_path: pathlib.Path, rounds: int) -> dict:
+    """Measure the parse time and peak RSS of an engine on a single report
+
+    Runs in a fresh worker process, so the peak RSS is not polluted by the previous runs.
+
+    Args:
+        engine (str): Parsing engine
+        report_path (pathlib.Path): Path to the report
+        rounds (int): Number of times the report is parsed
+
+    Returns:
+        dict: Returns the timings in seconds and the peak RSS in KiB
+    """
+    timings = []
+    for _ in range(rounds):
+        report = file_to_bytesio(report_path)
+        start = time.perf_counter()
+        get_alerts(report, engine=engine)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_engines(reports: list[pathlib.Path], rounds: int) -> None:
+    """Compare parse time and peak RSS of all engines
+
+    Args:
+        reports (list[pathlib.Path]): Reports to parse
+        rounds (int): Number of times every report is parsed
+    """
+    print(f"{'report':<42} {'engine':<8} {'median ms':>10} {'min ms':>10} {'peak RSS MiB':>13}")
+    for report_path in reports:
+        for engine in ENGINES:
+            with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(measure_engine, (engine, report_path, rounds))
+
+            print(
+                f"{report_path.name:<42} {engine:<8} {result['median'] * 1000:>10.1f} "
+                f"{result['min'] * 1000:>10.1f} {result['max_rss'] / 1024:>13.1f}"
+            )
+
+
+def verify_pipeline(reports: list[pathlib.Path]) -> bool:
+    """Check that every engine produces the expected alerts of the reports and the same alerts as the reference
+    detect/squash/enrich pipeline
+
+    The expected alerts are in EXPECTED_DIR, one JSON file per report. They were produced by the original
+    pipeline, before the engines and the reference pipeline shared the parsing of the metadata, timeslices and texts,
+    so a regression in that shared code is caught too.
+
+    Args:
+        reports (list[pathlib.Path]): Reports to check
+
+    Returns:
+        bool: True if all engines produce the expected alerts and match the reference pipeline, False otherwise
+    """
+    is_equal = True
+    for report_path in reports:
+        parsed_report = parse_report(read_in_memory_file(file_to_bytesio(report_path)))
+        alerts = squash_alerts(detect_alerts(parsed_report))
+        # Through JSON, as the expected alerts are stored: the datetimes as strings
+        reference = json.loads(json.dumps(enrich_alert(parsed_report["metadata"], alerts), default=str))
+
+        expected_path = EXPECTED_DIR / f"{report_path.stem}.json"
+        if not expected_path.exists():
+            print(f"{report_path.name:<42} {'-':<8} MISSING {expected_path}")
+            is_equal = False
+            continue
+
+        expected = json.loads(expected_path.read_text())
+        for engine in ENGINES:
+            actual = json.loads(json.dumps(get_alerts(file_to_bytesio(report_path), engine=engine), default=str))
+            mismatches = [name for name, other in (("expected", expected), ("reference", reference)) if actual != other]
+            result = f"MISMATCH {', '.join(mismatches)}" if mismatches else "ok"
+            print(f"{report_path.name:<42} {engine:<8} {result}")
+            is_equal = is_equal and not mismatches
+
+    return is_equal
+
+
+def bench_detect(report_path: pathlib.Path, rounds: int, max_ms: typing.Optional[float]) -> bool:
+    """Microbenchmark of detect_alerts on an already parsed report
+
+    Args:
+        report_path (pathlib.Path): Path to the report
+        rounds (int): Number of rounds, every round runs detect_alerts 10 times
+        max_ms (typing.Optional[float]): Maximum allowed median time per call in milliseconds
+
+    Returns:
+        bool: True if the median time is within max_ms (or no limit is given), False otherwise
+    """
+    parsed_report = parse_report(read_in_memory_file(file_to_bytesio(report_path)))
+
+    timings = [t / 10 for t in timeit.repeat(lambda: detect_alerts(parsed_report), number=10, repeat=rounds)]
+    median_ms = statistics.median(timings) * 1000
+
+    print(f"detect_alerts on {report_path.name}: median {median_ms:.3f} ms, min {min(timings) * 1000:.3f} ms")
+
+    if max_ms is not None and median_ms > max_ms:
+        print(f"Regression: median {median_ms:.3f} ms is above the limit of {max_ms:.3f} ms")
+        return False
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the KNMI report parser")
+    parser.add_argument("command", choices=["engines", "verify", "detect"], help="Benchmark to run")
+    parser.add_argument("reports", nargs="*", type=pathlib.Path, help="Reports to use, defaults to the sample reports")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of rounds per report")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail the detect benchmark above this median")
+    args = parser.parse_args()
+
+    reports = args.reports or sorted(REPORTS_DIR.glob("*.xml"))
+
+    match args.command:
+        case "engines":
+            bench_engines(reports, args.rounds)
+        case "verify":
+            if not verify_pipeline(reports):
+                raise SystemExit(1)
+        case "detect":
+            if not bench_detect(args.reports[0] if args.reports else DETECT_REPORT, args.rounds, args.max_ms):
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
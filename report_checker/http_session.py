@@ -0,0 +1,41 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def create_session(
+    retries: int = 3, backoff_factor: float = 0.5, backoff_jitter: float = 0.5, pool_size: int = 4
+) -> requests.Session:
+    """Create a HTTP session with connection pooling, keep-alive and retries
+
+    Connections are kept alive and reused between requests, so a report does not pay for a new TLS handshake
+    with the KNMI API and the download host. Requests that fail with 429 or 5xx, or fail to connect, are retried
+    with exponential backoff and jitter, honouring the Retry-After header.
+
+    Args:
+        retries (int, optional): Maximum number of retries. Defaults to 3.
+        backoff_factor (float, optional): Backoff factor in seconds. Defaults to 0.5.
+        backoff_jitter (float, optional): Maximum random jitter added to the backoff in seconds. Defaults to 0.5.
+        pool_size (int, optional): Number of connections kept per host. Defaults to 4.
+
+    Returns:
+        requests.Session: HTTP session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_jitter,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods={"GET"},
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+
+    return session
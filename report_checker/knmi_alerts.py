@@ -2,9 +2,21 @@ import collections
 import datetime
 import io
 import pathlib
+import sys
+import typing
+import xml.etree.ElementTree as ET
 
 import xmltodict
 
+ENGINES = ("dict", "stream")
+
+
+class ReportFile(typing.Protocol):
+    """Binary file the report is read from, e.g. an open file, io.BytesIO or a HashingReader over a download"""
+
+    def read(self, size: int = -1, /) -> bytes: ...
+
+
 # import copy
 
 
@@ -34,11 +46,11 @@ def file_to_bytesio(filepath):
     return bytes_io
 
 
-def read_in_memory_file(file: io.BytesIO) -> dict:
+def read_in_memory_file(file: ReportFile) -> dict:
     """Reads a file from memory and returns the content as a dictionary
 
     Args:
-        file (io.BytesIO): File in memory
+        file (ReportFile): File in memory
 
     Returns:
         dict: Returns the content of the file as a dictionary
@@ -49,59 +61,204 @@ def read_in_memory_file(file: io.BytesIO) -> dict:
     return result["report"]
 
 
-def parse_report(report: dict) -> dict:
-    """Parses the report and returns a dictionary with the metadata and forecast
+def parse_metadata(report_structure: dict) -> dict:
+    """Parses the report structure and returns the lookup tables for locations, criteria and phenomena
+
+    Location, phenomenon and criterion ids are interned, so the lookups in the forecast loop compare by identity.
 
     Args:
-        report (dict): Report as a dictionary
+        report_structure (dict): Report structure as a dictionary
 
     Returns:
-        dict: Returns a dictionary with the metadata and forecast
+        dict: Returns a dictionary with the locations, criteria, phenomena, the set of green (non-alerting)
+            criteria and the table of resolved alert texts
     """
-    report_metadata = report["metadata"]["report_structure"]
-
     phenonema = {
-        item["phenomenon_id"]: {"phenomenon_name": item["report_phenomenon_descr"]["text"]["text_header"]}
-        for item in report_metadata["report_phenomena"]["report_phenomenon"]
+        sys.intern(item["phenomenon_id"]): {"phenomenon_name": item["report_phenomenon_descr"]["text"]["text_header"]}
+        for item in report_structure["report_phenomena"]["report_phenomenon"]
     }
     criteria = {
-        item["criterion_id"]: {"color": item["color_id"], "description": item["criterion_descr"]}
-        for item in report_metadata["report_criteria"]["report_criterion"]
+        sys.intern(item["criterion_id"]): {"color": item["color_id"], "description": item["criterion_descr"]}
+        for item in report_structure["report_criteria"]["report_criterion"]
     }
     locations = {
-        item["location_id"]: item["location_descr"]["text"]["text_header"]
-        for item in report_metadata["report_locations"]["report_location"]
+        sys.intern(item["location_id"]): item["location_descr"]["text"]["text_header"]
+        for item in report_structure["report_locations"]["report_location"]
     }
+    green_criteria = frozenset(code for (code, criteria) in criteria.items() if criteria["color"].lower() == "green")
+
+    return {
+        "locations": locations,
+        "criteria": criteria,
+        "phenomena": phenonema,
+        "green_criteria": green_criteria,
+        "texts": {},
+    }
+
+
+def resolve_text(text: typing.Union[dict, list], texts: dict) -> dict:
+    """Resolves the text entries of a location to a dictionary keyed by language
+
+    The same text is repeated in every timeslice of an alert, so the resolved dictionaries are shared via the
+    texts table of the report metadata.
+
+    Args:
+        text (typing.Union[dict, list]): Text entries of the location
+        texts (dict): Table of already resolved texts
+
+    Returns:
+        dict: Returns the text of the location keyed by language
+    """
+    if isinstance(text, dict):
+        text = [text]
+
+    key = tuple((txt["text_language_id"], txt["text_data"]) for txt in text)
+    resolved = texts.get(key)
+    if resolved is None:
+        resolved = texts[key] = dict(key)
+
+    return resolved
 
-    # every 2 hours we get a report that contains 48 elements where it shows the condition of the weather
-    forecast = [
-        {
-            "timeslice": item["timeslice_id"],
-            "phenonema": {
-                p["phenomenon_id"]: [
-                    {
-                        "criterion": location_report["criterion_id"],
-                        "location": location_report["location_id"],
-                        "text": location_report["text"],
-                    }
-                    for location_report in p["location"]
-                ]
-                for p in item["phenomenon"]
-            },
-        }
-        for item in report["data"]["cube"]["timeslice"]
-    ]
+
+def parse_timeslice(timeslice: dict, report_metadata: dict) -> dict:
+    """Parses a single timeslice of the forecast
+
+    Args:
+        timeslice (dict): Timeslice as a dictionary
+        report_metadata (dict): Report metadata, see parse_metadata
+
+    Returns:
+        dict: Returns a dictionary with the condition of every location per phenomenon, the text is only
+            resolved for the alerting criteria
+    """
+    green_criteria = report_metadata["green_criteria"]
+    texts = report_metadata["texts"]
 
     return {
-        "metadata": {
-            "locations": locations,
-            "criteria": criteria,
-            "phenomena": phenonema,
+        "timeslice": timeslice["timeslice_id"],
+        "phenonema": {
+            sys.intern(p["phenomenon_id"]): [
+                {
+                    "criterion": sys.intern(location_report["criterion_id"]),
+                    "location": sys.intern(location_report["location_id"]),
+                    "text": None
+                    if location_report["criterion_id"] in green_criteria
+                    else resolve_text(location_report["text"], texts),
+                }
+                for location_report in p["location"]
+            ]
+            for p in timeslice["phenomenon"]
         },
+    }
+
+
+def parse_report(report: dict) -> dict:
+    """Parses the report and returns a dictionary with the metadata and forecast
+
+    Args:
+        report (dict): Report as a dictionary
+
+    Returns:
+        dict: Returns a dictionary with the metadata and forecast
+    """
+    report_metadata = parse_metadata(report["metadata"]["report_structure"])
+
+    # every 2 hours we get a report that contains 48 elements where it shows the condition of the weather
+    forecast = [parse_timeslice(item, report_metadata) for item in report["data"]["cube"]["timeslice"]]
+
+    return {
+        "metadata": report_metadata,
         "forecast": forecast,
     }
 
 
+def element_to_dict(element: ET.Element) -> typing.Any:
+    """Converts an element to the same structure xmltodict produces for it
+
+    Repeated children become lists, leaf elements become their stripped text (or None when empty).
+
+    Args:
+        element (ET.Element): Parsed XML element
+
+    Returns:
+        typing.Any: Returns a dictionary for elements with children, otherwise the text of the element
+    """
+    if len(element) == 0:
+        text = (element.text or "").strip()
+        return text or None
+
+    result: dict = {}
+    for child in element:
+        value = element_to_dict(child)
+        if child.tag not in result:
+            result[child.tag] = value
+        elif isinstance(result[child.tag], list):
+            result[child.tag].append(value)
+        else:
+            result[child.tag] = [result[child.tag], value]
+
+    return result
+
+
+def get_report_issued(file: typing.BinaryIO) -> datetime.datetime:
+    """Reads the issue time of the report, parsing stops right after it
+
+    Args:
+        file (typing.BinaryIO): Report file
+
+    Raises:
+        ValueError: The report has no issue time
+
+    Returns:
+        datetime.datetime: Issue time of the report (report_dtg_issued)
+    """
+    for _, element in ET.iterparse(file, events=("end",)):
+        if element.tag == "report_dtg_issued":
+            if not element.text or not element.text.strip():
+                raise ValueError("Report issue time is empty")
+            return datetime.datetime.fromisoformat(element.text.strip())
+
+    raise ValueError("Report issue time not found")
+
+
+def stream_report(file: ReportFile) -> dict:
+    """Parses the report incrementally and returns a dictionary with the metadata and a lazy forecast
+
+    The report structure is read first, after that every timeslice is parsed when it arrives and discarded
+    right after, so only one timeslice is kept in memory at a time. Parsing stops at the end of the cube,
+    the attachments that follow it are never read.
+
+    Args:
+        file (ReportFile): Report file
+
+    Returns:
+        dict: Returns a dictionary with the metadata and a forecast generator, same shape as parse_report
+    """
+    events = ET.iterparse(file, events=("end",))
+
+    metadata = None
+    for _, element in events:
+        if element.tag == "report_structure":
+            metadata = parse_metadata(element_to_dict(element))
+            element.clear()
+            break
+
+    assert metadata is not None, "Report structure not found"
+
+    def forecast() -> typing.Iterator[dict]:
+        for _, element in events:
+            if element.tag == "timeslice":
+                yield parse_timeslice(element_to_dict(element), metadata)
+                element.clear()
+            elif element.tag == "cube":
+                break
+
+    return {
+        "metadata": metadata,
+        "forecast": forecast(),
+    }
+
+
 def detect_alerts(report: dict) -> dict:
     """Detects alerts in the report for each location
 
@@ -119,23 +276,17 @@ def detect_alerts(report: dict) -> dict:
     for location in locations:
         result[location] = {phenonema: list() for phenonema in report["metadata"]["phenomena"]}
 
-    green_criteria = [
-        code for (code, criteria) in report["metadata"]["criteria"].items() if criteria["color"].lower() == "green"
-    ]
+    green_criteria = report["metadata"]["green_criteria"]
 
     for forecast in report["forecast"]:
-        for phenonema in forecast["phenonema"].keys():
-            for location in forecast["phenonema"][phenonema]:
+        for phenonema, locations in forecast["phenonema"].items():
+            for location in locations:
                 if location["criterion"] not in green_criteria:
-                    text = {}
-                    for txt in location["text"]:
-                        text[txt["text_language_id"]] = txt["text_data"]
-
                     result[location["location"]][phenonema].append(
                         {
                             "time": datetime.datetime.fromisoformat(forecast["timeslice"]),
                             "criterion": location["criterion"],
-                            "text": text,
+                            "text": location["text"],
                         }
                     )
 
@@ -194,11 +345,79 @@ def enrich_alert(report_metadata: dict, alerts: dict) -> dict:
     return result
 
 
-def get_alerts(report_file: io.BytesIO) -> dict:
+def collect_alerts(report: dict) -> dict:
+    """Detects, squashes and enriches the alerts in a single pass over the forecast
+
+    Produces the same result as enrich_alert(squash_alerts(detect_alerts(report))), but only keeps a running
+    start/end/last-criterion record per (location, phenomenon) instead of a list of alerts per timeslice,
+    so the forecast can be consumed lazily.
+
+    Args:
+        report (dict): Parsed report, see parse_report and stream_report
+
+    Returns:
+        dict: Returns a dictionary with the enriched alerts for each location
+    """
+    report_metadata = report["metadata"]
+
+    green_criteria = report_metadata["green_criteria"]
+
+    running = {}
+    for forecast in report["forecast"]:
+        time = None
+        for phenonema, locations in forecast["phenonema"].items():
+            for location in locations:
+                if location["criterion"] in green_criteria:
+                    continue
+
+                if time is None:
+                    time = datetime.datetime.fromisoformat(forecast["timeslice"])
+
+                record = running.get((location["location"], phenonema))
+                if record is None:
+                    running[(location["location"], phenonema)] = {
+                        "start_time": time,
+                        "end_time": time,
+                        "criterion": location["criterion"],
+                        "text": location["text"],
+                    }
+                else:
+                    record["end_time"] = time
+                    record["criterion"] = location["criterion"]
+                    record["text"] = location["text"]
+
+    result = {location: list() for location in report_metadata["locations"].values()}
+
+    for location, location_name in report_metadata["locations"].items():
+        records = [
+            (phenonema, running[(location, phenonema)])
+            for phenonema in report_metadata["phenomena"]
+            if (location, phenonema) in running
+        ]
+        if not records:
+            continue
+
+        result[location_name] = [
+            {
+                "phenomenon_name": report_metadata["phenomena"][phenonema]["phenomenon_name"],
+                "code": report_metadata["criteria"][record["criterion"]]["color"],
+                "start_time": record["start_time"],
+                "end_time": record["end_time"],
+                "text": record["text"],
+            }
+            for phenonema, record in records
+        ]
+
+    return result
+
+
+def get_alerts(report_file: ReportFile, engine: str = "dict") -> dict:
     """Get the alerts from the report
 
     Args:
-        report_file (io.BytesIO): Report file
+        report_file (ReportFile): Report file, e.g. io.BytesIO or a streamed response body
+        engine (str, optional): "dict" parses the whole document with xmltodict, "stream" parses it
+            incrementally timeslice by timeslice. Defaults to "dict".
 
     Returns:
         dict: Returns the alerts from the report
@@ -208,14 +427,15 @@ def get_alerts(report_file: io.BytesIO) -> dict:
     # file = file_to_bytesio("./test_file.xml")
 
     assert report_file, "Report file is empty"
+    assert engine in ENGINES, f"Unknown engine {engine}"
 
-    report = read_in_memory_file(report_file)
-    parsed_report = parse_report(report)
-    alerts = detect_alerts(parsed_report)
-    alerts = squash_alerts(alerts)
-    final_alerts = enrich_alert(parsed_report["metadata"], alerts)
+    if engine == "stream":
+        parsed_report = stream_report(report_file)
+    else:
+        report = read_in_memory_file(report_file)
+        parsed_report = parse_report(report)
 
-    return final_alerts
+    return collect_alerts(parsed_report)
 
 
 def main():
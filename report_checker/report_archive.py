@@ -0,0 +1,182 @@
+import bisect
+import datetime
+import gzip
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import typing
+
+from knmi_alerts import get_report_issued
+
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+INDEX_FILE = "index.jsonl"
+
+
+class ArchiveEntry(typing.NamedTuple):
+    issued: datetime.datetime
+    report_hash: str
+    filename: str
+    size: int
+
+
+class ReportArchive:
+    """Local archive of the downloaded reports
+
+    Reports are stored gzip compressed, one file per report, deduplicated by content hash. The index is an
+    append-only JSON lines file that is loaded into a list sorted by issue time, so the latest report, the report
+    at a given time and a range of reports are found with a binary search. Reports older than `max_age` are evicted,
+    then the oldest reports are evicted until the archive fits in `max_bytes`.
+    """
+
+    def __init__(self, path: pathlib.Path, max_age: datetime.timedelta, max_bytes: int):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+        self._entries: typing.List[ArchiveEntry] = []
+        self._issued: typing.List[datetime.datetime] = []
+        self._hashes: typing.Set[str] = set()
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+        self.evict()
+
+    def _load_index(self) -> None:
+        index_path = self.path / INDEX_FILE
+        if not index_path.exists():
+            return
+
+        with open(index_path, "r") as fd:
+            entries = [self._decode(line) for line in fd if line.strip()]
+
+        for entry in sorted(entries):
+            if (self.path / entry.filename).exists() and entry.report_hash not in self._hashes:
+                self._insert(entry)
+
+    @staticmethod
+    def _decode(line: str) -> ArchiveEntry:
+        item = json.loads(line)
+        return ArchiveEntry(datetime.datetime.fromisoformat(item["issued"]), item["hash"], item["filename"], item["size"])
+
+    @staticmethod
+    def _encode(entry: ArchiveEntry) -> str:
+        return json.dumps(
+            {"issued": entry.issued.isoformat(), "hash": entry.report_hash, "filename": entry.filename, "size": entry.size}
+        )
+
+    def _insert(self, entry: ArchiveEntry) -> None:
+        position = bisect.bisect_right(self._issued, entry.issued)
+        self._issued.insert(position, entry.issued)
+        self._entries.insert(position, entry)
+        self._hashes.add(entry.report_hash)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, report_hash: str) -> bool:
+        return report_hash in self._hashes
+
+    def add(self, report: typing.BinaryIO, report_hash: str) -> typing.Optional[ArchiveEntry]:
+        """Compress and store the report, reports that are already archived are skipped
+
+        Args:
+            report (typing.BinaryIO): Seekable report file, it is rewound after storing, also when storing fails
+            report_hash (str): Hash of the report
+
+        Returns:
+            typing.Optional[ArchiveEntry]: Archived entry, None if the report was already archived
+        """
+        if report_hash in self._hashes:
+            return None
+
+        try:
+            report.seek(0)
+            issued = get_report_issued(report).astimezone(datetime.timezone.utc)
+            report.seek(0)
+
+            filename = f"knmi_waarschuwingen_{issued:%Y%m%d%H%M}_{report_hash[:16]}.xml.gz"
+            tmp = tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False)
+            try:
+                with tmp, gzip.GzipFile(fileobj=tmp, mode="wb") as fd:
+                    shutil.copyfileobj(report, fd)
+                os.replace(tmp.name, self.path / filename)
+            except BaseException:
+                # e.g. the disk is full, the partial file is not left behind
+                pathlib.Path(tmp.name).unlink(missing_ok=True)
+                raise
+        finally:
+            # Also when archiving fails, the report is parsed after it
+            report.seek(0)
+
+        entry = ArchiveEntry(issued, report_hash, filename, (self.path / filename).stat().st_size)
+        with open(self.path / INDEX_FILE, "a") as fd:
+            fd.write(self._encode(entry) + "\n")
+        self._insert(entry)
+
+        self.evict()
+
+        return entry
+
+    def open(self, entry: ArchiveEntry) -> gzip.GzipFile:
+        """Open the archived report for reading
+
+        Args:
+            entry (ArchiveEntry): Archived entry
+
+        Returns:
+            gzip.GzipFile: Decompressed report
+        """
+        return gzip.GzipFile(self.path / entry.filename, "rb")
+
+    def latest(self) -> typing.Optional[ArchiveEntry]:
+        """Get the most recently issued report"""
+        return self._entries[-1] if self._entries else None
+
+    def at(self, time: datetime.datetime) -> typing.Optional[ArchiveEntry]:
+        """Get the report that was valid at the given time, i.e. the last report issued at or before it"""
+        position = bisect.bisect_right(self._issued, time)
+        return self._entries[position - 1] if position else None
+
+    def range(self, start: datetime.datetime, end: datetime.datetime) -> typing.List[ArchiveEntry]:
+        """Get the reports issued between start and end, both inclusive, ordered by issue time"""
+        return self._entries[bisect.bisect_left(self._issued, start) : bisect.bisect_right(self._issued, end)]
+
+    def evict(self) -> int:
+        """Evict the reports that are too old, then the oldest ones until the archive fits in max_bytes
+
+        Returns:
+            int: Number of evicted reports
+        """
+        oldest_allowed = datetime.datetime.now(datetime.timezone.utc) - self.max_age
+        total_size = sum(entry.size for entry in self._entries)
+
+        evicted = 0
+        while self._entries and (self._entries[0].issued < oldest_allowed or total_size > self.max_bytes):
+            entry = self._entries.pop(0)
+            self._issued.pop(0)
+            self._hashes.discard(entry.report_hash)
+            (self.path / entry.filename).unlink(missing_ok=True)
+            total_size -= entry.size
+            evicted += 1
+
+        if evicted:
+            self._rewrite_index()
+            logger.info(f"Evicted {evicted} reports from the archive")
+
+        return evicted
+
+    def _rewrite_index(self) -> None:
+        tmp = tempfile.NamedTemporaryFile("w", dir=self.path, suffix=".tmp", delete=False)
+        try:
+            with tmp:
+                for entry in self._entries:
+                    tmp.write(self._encode(entry) + "\n")
+            os.replace(tmp.name, self.path / INDEX_FILE)
+        except BaseException:
+            pathlib.Path(tmp.name).unlink(missing_ok=True)
+            raise
@@ -0,0 +1,138 @@
+import hashlib
+import io
+import json
+import time
+import typing
+
+import redis  # ty: ignore[unresolved-import]
+
+
+def hash_report(report: io.BytesIO) -> str:
+    """Hash the content of the downloaded report
+
+    Args:
+        report (io.BytesIO): In-memory report
+
+    Returns:
+        str: SHA-256 hex digest of the report
+    """
+    return hashlib.sha256(report.getbuffer()).hexdigest()
+
+
+class HashingReader:
+    """File-like wrapper that hashes the content while it is read, so a streamed report is hashed without buffering it
+
+    The content can also be copied to a sink while it is read, e.g. a temporary file for the archive.
+    """
+
+    def __init__(self, file: typing.BinaryIO, sink: typing.Optional[typing.BinaryIO] = None):
+        self._file = file
+        self._sink = sink
+        self._hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        self._hash.update(data)
+        if self._sink is not None:
+            self._sink.write(data)
+        return data
+
+    def drain(self, chunk_size: int = 64 * 1024) -> None:
+        """Read the rest of the content, e.g. the part of the report the parser stopped before"""
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self) -> str:
+        """SHA-256 hex digest of the content read so far, same as hash_report for the whole content"""
+        return self._hash.hexdigest()
+
+
+def hash_alerts(alerts: dict) -> str:
+    """Hash the alerts in the same serialization that is published to Redis
+
+    Args:
+        alerts (dict): Alerts as returned by get_alerts
+
+    Returns:
+        str: SHA-256 hex digest of the alerts
+    """
+    return hashlib.sha256(json.dumps(alerts, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def is_known_report(r: redis.Redis, key: str, report_hash: str) -> bool:
+    """Check if the report was already processed
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the report cache
+        report_hash (str): Hash of the report
+
+    Returns:
+        bool: True if the report was already processed, False otherwise
+    """
+    return r.zscore(key, report_hash) is not None
+
+
+def remember_report(r: redis.Redis, key: str, report_hash: str, size: int) -> None:
+    """Add the report to the cache, keeping only the most recent `size` reports
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the report cache
+        report_hash (str): Hash of the report
+        size (int): Maximum number of reports in the cache
+    """
+    with r.pipeline() as pipe:
+        pipe.zadd(key, {report_hash: time.time()})
+        pipe.zremrangebyrank(key, 0, -size - 1)
+        pipe.execute()
+
+
+def get_last_alerts_hash(r: redis.Redis, key: str) -> str | None:
+    """Get the hash of the last published alerts
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the last published alerts hash
+
+    Returns:
+        str | None: Hash of the last published alerts, None if nothing was published yet
+    """
+    value = r.get(key)
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def set_last_alerts_hash(r: redis.Redis, key: str, alerts_hash: str) -> None:
+    """Store the hash of the last published alerts
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the last published alerts hash
+        alerts_hash (str): Hash of the published alerts
+    """
+    r.set(key, alerts_hash)
+
+
+def get_last_alerts(r: redis.Redis, key: str) -> dict:
+    """Get the last published alerts snapshot
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the last published alerts
+
+    Returns:
+        dict: Last published alerts, empty if nothing was published yet
+    """
+    value = r.get(key)
+    return json.loads(value) if value else {}
+
+
+def set_last_alerts(r: redis.Redis, key: str, alerts: dict) -> None:
+    """Store the last published alerts snapshot
+
+    Args:
+        r (redis.Redis): Redis client
+        key (str): Key of the last published alerts
+        alerts (dict): Published alerts, normalized
+    """
+    r.set(key, json.dumps(alerts))